@@ -7,9 +7,25 @@
 # developers.
 #
 
+import bisect
+import collections.abc
+import concurrent.futures
+import contextlib
+import gc
+import hashlib
+import heapq
+import io
+import json
 import logging
+import math
+import mmap
 import os
+import pickle
 import re
+import sqlite3
+import sys
+import time
+import types
 
 # Regex expressions
 # Note for self: (?:...) is a non-capturing group
@@ -23,6 +39,74 @@ RE_CONFIG = re.compile(CONFIG)
 RE_VARIABLE = re.compile(r'^(\S+)\s+:?=\s*(.*)')
 RE_MACRO = re.compile(r'^\$\(.+\)')
 RE_IF = re.compile(r'^if\s+(.*)$')
+RE_BLOCK_KEYWORD = re.compile(r'(endif|endmenu|choice|endchoice)\b')
+RE_EXPR_TOKEN = re.compile(r'"[^"]*"|\w+')
+RE_SYMBOL = re.compile(SYMBOL)
+RE_MAKEFILE_OBJ = re.compile(r'obj-\$\(CONFIG_([^\)]+)\)$')
+RE_MAKEFILE_DIRS = re.compile(r'(obj|subdir|core|drivers|libs|net|virt)-'
+                              r'(y|m|\$\(.+\))$')
+RE_MAKEFILE_GATE = re.compile(r'CONFIG_(\w+)')
+RE_MAKEFILE_ASSIGN = re.compile(r'\s*([\w.-]+(?:-\$\([^=]*\))?)\s*'
+                                r'([:+?]?=)\s*(.*?)\s*$')
+RE_MAKEFILE_COND = re.compile(r'-\$\(.*\)$')
+RE_MAKEFILE_INCLUDE = re.compile(r'\s*-?include\s+(.*)')
+RE_MAKEFILE_BUILD = re.compile(r'\$\(build\)=(\S+)')
+RE_SEARCH_WORD = re.compile(r'[a-z0-9_]+')
+
+# Symbol data keys
+SYMBOL_KEYS = ('name', 'kconfig', 'help', 'depends_on', 'select', 'type',
+               'default', 'range', 'option', 'imply', 'prompt', 'if', 'menu',
+               'choice')
+
+# Reverse dependency indexes and the symbol options they're built from
+RDEPS = {
+    'selected_by': 'select',
+    'implied_by': 'imply',
+    'depended_on_by': 'depends_on',
+    'default_referenced_by': 'default',
+}
+
+# Symbol options that are collected as plain lists of strings
+SYMBOL_OPTIONS = ('help', 'depends_on', 'select', 'range', 'option', 'imply',
+                  'prompt')
+
+# Records of the options of the current symbol
+SYMBOL_RECORDS = frozenset(SYMBOL_OPTIONS + ('type', 'default', 'help_end',
+                                             'help_range'))
+
+# Directory of the parse caches, relative to the user's cache directory. Bump
+# the parser version whenever the parsed records change to invalidate existing
+# caches.
+CACHE_DIR = 'kconfig'
+PARSER_VERSION = 9
+
+# Top level directories without kernel objects, skipped when walking a tree
+# for its Makefiles
+MAKEFILE_PRUNE = ('Documentation', 'scripts', 'tools')
+
+# The make functions that are expanded in Makefiles with their number of
+# arguments, and the value of undefined variables and unsupported functions
+MAKE_FUNCTIONS = {
+    'addprefix': 2,
+    'addsuffix': 2,
+    'patsubst': 3,
+    'sort': 1,
+    'strip': 1,
+    'subst': 3,
+}
+MAKE_UNDEFINED = '\0'
+
+# Weights of the words of the symbol texts in the help search index
+SEARCH_WEIGHTS = {
+    'prompt': 3,
+    'menu': 2,
+    'help': 1,
+}
+
+# Number of materialized help texts and memory-mapped Kconfig files kept by
+# the lazy help loader
+HELP_CACHE_SIZE = 1024
+HELP_FILES_SIZE = 32
 
 # Mapping between Debian package and kernel source architecture names
 SRCARCH = {
@@ -94,410 +178,1656 @@ def read_line(fh):
 
         yield line.replace('\t', ' ' * 8)
 
-class Kconfig():
-    def __init__(self, ksource, kconfig, arch, log_level=logging.INFO,
-                 test=False):
-        self.ksource = ksource
-        self.kconfig = kconfig
-        self.arch = arch
-        self.test = test
-        self.symbols = {}
+def _quoted(arg):
+    """
+    Return the non-empty double-quoted string at the start of arg or None
+    """
+    if not arg or arg[0] != '"':
+        return None
+    end = arg.find('"', 1)
+    if end <= 1:
+        return None
+    return arg[1:end]
+
+def _argument(arg, word):
+    """
+    Return the remainder of arg if it starts with the provided word followed
+    by another argument, like 'on' in 'depends on FOO', or None
+    """
+    if arg is None:
+        return None
+    words = arg.split(None, 1)
+    if words[0] != word or len(words) < 2:
+        return None
+    return words[1]
+
+def expr_symbols(expr):
+    """
+    Return the symbols referenced by a Kconfig expression, in order
+    """
+    result = []
+    for token in RE_EXPR_TOKEN.findall(expr):
+        if token[0] != '"' and not token[0].isdigit() and \
+           RE_SYMBOL.fullmatch(token):
+            result.append(token)
+    return result
+
+def _rdep_tokens(symbol, option):
+    """
+    Return the symbols referenced by the provided option of a symbol that are
+    indexed as reverse dependencies
+    """
+    tokens = []
+    for val in symbol[option]:
+        if option in ('select', 'imply'):
+            tokens.extend(val.split(None, 1)[:1])
+        elif option == 'default':
+            tokens.extend(expr_symbols(next(iter(val.values()))))
+        else:
+            tokens.extend(expr_symbols(val))
+    return tokens
 
-        # Setup the logger
-        logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s',
-                            datefmt='%Y-%m-%d %H:%M:%S',
-                            level=log_level)
-        self._log = logging.getLogger(__name__)
+def _search_texts(symbol):
+    """
+    Return the prompts, the innermost menu title or choice prompt and the help
+    text of a symbol with their search weights
+    """
+    texts = []
+    for entry in symbol['type']:
+        for val in entry.values():
+            if val and val.startswith('"'):
+                texts.append((split_condition(val)[0],
+                              SEARCH_WEIGHTS['prompt']))
+    for val in symbol['prompt']:
+        texts.append((split_condition(val)[0], SEARCH_WEIGHTS['prompt']))
+    if symbol['choice']:
+        texts.append((symbol['choice'][-1]['prompt'], SEARCH_WEIGHTS['menu']))
+    elif symbol['menu']:
+        texts.append((symbol['menu'][-1]['menu'], SEARCH_WEIGHTS['menu']))
+    texts.append((' '.join(symbol['help']), SEARCH_WEIGHTS['help']))
+    return texts
+
+@contextlib.contextmanager
+def _paused_gc():
+    """
+    Pause the cyclic garbage collector while a large number of objects
+    without cycles is created, rescanning them over and over takes a good
+    part of the time otherwise. Restores the previous state of the collector.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def _intern(val):
+    """
+    Intern a string so that equal expressions are stored only once
+    """
+    return sys.intern(val) if isinstance(val, str) else val
 
-        # The list of all makefiles
-        self._makefiles = []
+class Symbol(collections.abc.Mapping):
+    """
+    The data of a single symbol. The options are collected in lists of
+    interned strings and shared type and default dicts while the Kconfig tree
+    is parsed and frozen into tuples afterwards. The 'if', 'menu' and 'choice'
+    contexts are tuples that are shared between all symbols with the same
+    nesting.
+
+    Provides a read-only dict interface with the keys in SYMBOL_KEYS for
+    existing callers and JSON serialization (json.dumps(..., default=dict)).
+    """
+    __slots__ = SYMBOL_KEYS + ('loader',)
 
-        # 'if' conditions
-        self._if = []
+    def __init__(self, name, if_, menu, choice, loader=None):
+        self.name = name
+        for key in SYMBOL_KEYS[1:-3]:
+            setattr(self, key, [])
+        setattr(self, 'if', if_)
+        self.menu = menu
+        self.choice = choice
 
-        # 'menu' conditions
-        self._menu = []
+        # The help loader of lazily loaded symbols. Their help is a tuple of
+        # byte ranges that is materialized on access.
+        self.loader = loader
 
-        # 'choice' conditions
-        self._choice = []
+    def __getitem__(self, key):
+        if key not in SYMBOL_KEYS:
+            raise KeyError(key)
+        if key == 'help' and self.loader:
+            return self.loader.load(self.help)
+        return getattr(self, key)
 
-        # Parse the Kconfig tree
-        self._kconfigs = {}
-        self._parse_kconfig(self.kconfig)
+    def __iter__(self):
+        return iter(SYMBOL_KEYS)
 
-    def _log_line(self, tokens, line, warning=False):
-        token = '[{}]'.format(':'.join([t.lower() for t in tokens]))
-        if warning:
-            self._log.warning('%18s : %s', token, line)
-        else:
-            self._log.debug('%20s : %s', token, line)
+    def __len__(self):
+        return len(SYMBOL_KEYS)
 
-    def _find_makefiles(self):
+    def __repr__(self):
+        return 'Symbol({!r})'.format(dict(self))
+
+    def freeze(self):
         """
-        Find all Makefiles and Kbuild files
+        Convert the option lists to tuples
         """
-        self._log.debug('Find Makefiles an Kbuild files')
+        for key in SYMBOL_KEYS[1:-3]:
+            setattr(self, key, tuple(getattr(self, key)))
 
-        result = []
-        for path, _dirs, files in os.walk(self.ksource):
-            rel_path = os.path.relpath(path, self.ksource)
-            for f in files:
-                if f in ('Makefile', 'Kbuild'):
-                    result.append(os.path.join(rel_path, f))
-        return result
+class _ParseState():
+    """
+    The state of the parser while reading a single Kconfig file
+    """
+    __slots__ = ('token', 'option', 'help_indent', 'help_start', 'help_end',
+                 'offset', 'regex', 'records')
 
-    def _parse_kconfig(self, kconfig):  # pylint: disable=R0915
-        """
-        Parse the provided kconfig file and recursively traverse all included
-        kconfig files as well.
-        """
-        # Prevent reading the same Kconfig multiple times
-        if kconfig in self._kconfigs:
-            return
-        self._kconfigs[kconfig] = 1
+    def __init__(self):
+        self.token = 'NONE'
+        self.option = 'NONE'
+        self.help_indent = 0
 
-        # Assemble the full kconfig file path and replace environment variables
-        source = os.path.join(self.ksource, kconfig)
-        source = source.replace('$(SRCARCH)', SRCARCH.get(self.arch, self.arch))
-        source = source.replace('$SRCARCH', SRCARCH.get(self.arch, self.arch))
+        # Byte range of the current help text and byte offset of the file
+        # reader
+        self.help_start = None
+        self.help_end = 0
+        self.offset = 0
 
-        with open(source) as fh:
-            token = 'NONE'
-            option = 'NONE'
-            name = None
-            help_indent = 0
+        # Number of regex evaluations
+        self.regex = 0
 
-            for line in read_line(fh):
+        self.records = []
+
+class _Reader():
+    """
+    Parser for single Kconfig files. It doesn't keep any state between files
+    so that files can be parsed in worker processes. With lazy_help only the
+    byte ranges of the help texts are recorded, not their lines.
+    """
+    def __init__(self, ksource, log, test=False, profile=None,
+                 lazy_help=False):
+        self.ksource = ksource
+        self.test = test
+        self.profile = profile
+        self.lazy_help = lazy_help
+        self._log = log
+        self._debug = log.isEnabledFor(logging.DEBUG)
+
+        # Lines are only passed to _log_line if they are logged or profiled,
+        # except for the warnings about ignored lines
+        self._trace = self._debug or profile is not None
+
+    def _log_line(self, tokens, line, warning=False):
+        branch = ':'.join([t.lower() for t in tokens])
+        if self.profile is not None:
+            self.profile.branches[branch] += 1
+        if warning:
+            self._log.warning('%18s : %s', '[' + branch + ']', line)
+        elif self._debug:
+            self._log.debug('%20s : %s', '[' + branch + ']', line)
+
+    def read(self, source, known=None):
+        """
+        Parse a single Kconfig file and return the list of (op, value) records
+        that Kconfig._parse_kconfig replays to populate the symbols. known
+        maps content digests to the records of already parsed files with the
+        same content, which are returned without parsing the file again.
+        """
+        self._log.debug('Parse %s', source)
+        if self.profile is not None:
+            start = time.perf_counter()
+
+        st = _ParseState()
+        line_end = 0
+        lineno = 0
+        with open(os.path.join(self.ksource, source), 'rb') as fh:
+            data = fh.read()
+            digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+            if known and digest in known:
+                if self.profile is not None:
+                    self.profile.add_cached(source)
+                return known[digest]
+            st.records.append(('digest', digest))
+            for lineno, line in enumerate(read_line(self._lines(data, st)),
+                                          1):
                 if self.test:
                     test_regex(line)
 
+                # Byte range of the (continued) line
+                line_start, line_end = line_end, st.offset
+
                 # Determine the line indentation
-                line_indent = len(re.match(r'^(\s*)', line).group(1))
+                stripped = line.lstrip()
+                line_indent = len(line) - len(stripped)
 
                 # -------------------------------------------------------------
                 # Collect config help lines
-                if token == 'CONFIG' and option == 'HELP':
-                    if not help_indent and line_indent:
+                if st.token == 'CONFIG' and st.option == 'HELP':
+                    if not st.help_indent and line_indent:
                         # Indentation of first line of help text
-                        help_indent = line_indent
-                    if help_indent:
-                        if line and line_indent < help_indent:
+                        st.help_indent = line_indent
+                    if st.help_indent:
+                        if line and line_indent < st.help_indent:
                             # End of help, remove trailing empty lines
-                            while not self.symbols[name]['help'][-1]:
-                                del self.symbols[name]['help'][-1]
-                            option = 'NONE'
+                            if not self.lazy_help:
+                                st.records.append(('help_end', None))
+                            st.records.append(('help_range', (
+                                st.help_start, st.help_end, st.help_indent,
+                                True, self._help_digest(data, st))))
+                            st.option = 'NONE'
                         else:
-                            self._log_line([token, 'help_text'], line)
-                            self.symbols[name]['help'].append(line[help_indent:])
+                            if self._trace:
+                                self._log_line([st.token, 'help_text'], line)
+                            if not self.lazy_help:
+                                st.records.append(('help',
+                                                   line[st.help_indent:]))
+                            if st.help_start is None:
+                                st.help_start = line_start
+                            st.help_end = line_end
                             continue
 
                 # -------------------------------------------------------------
                 # Ignore choice help lines
-                if token == 'CHOICE' and option == 'HELP':
-                    if not help_indent and line_indent:
+                if st.token == 'CHOICE' and st.option == 'HELP':
+                    if not st.help_indent and line_indent:
                         # Indentation of first line of help text
-                        help_indent = line_indent
-                    if help_indent:
-                        if line and line_indent < help_indent:
+                        st.help_indent = line_indent
+                    if st.help_indent:
+                        if line and line_indent < st.help_indent:
                             # End of help
-                            option = 'NONE'
+                            st.option = 'NONE'
                         else:
-                            self._log_line([token, 'help_text'], line)
+                            if self._trace:
+                                self._log_line([st.token, 'help_text'], line)
                             continue
 
-                # -------------------------------------------------------------
-                # Source included Kconfig file
-                m = RE_SOURCE.match(line)
-                if m:
-                    token = 'SOURCE'
-                    option = 'NONE'
-                    self._log_line([token], line)
-                    self._parse_kconfig(m.group(1))
+                # Empty line or a line with only a continuation
+                if not stripped:
+                    if line:
+                        self._log_line([st.token, 'ignored'], line,
+                                       warning=True)
                     continue
 
                 # -------------------------------------------------------------
                 # Ignore comments
-                if RE_COMMENT.match(line):
-                    self._log_line(['#'], line)
+                if stripped[0] == '#':
+                    if self._trace:
+                        self._log_line(['#'], line)
                     continue
 
-                # -------------------------------------------------------------
-                # Variable assignment
-                if RE_VARIABLE.match(line):
-                    self._log_line(['variable'], line)
-                    continue
+                # Split the line into the keyword and its argument
+                words = stripped.split(None, 1)
+                kw = words[0]
+                arg = words[1] if len(words) > 1 else None
+
+                if not line_indent:
+                    # ---------------------------------------------------------
+                    # Variable assignment
+                    if arg and (arg[0] == '=' or arg[:2] == ':='):
+                        if self._trace:
+                            self._log_line(['variable'], line)
+                        continue
+
+                    # ---------------------------------------------------------
+                    # Macro definition
+                    if kw.startswith('$(') and line.find(')', 3) != -1:
+                        if self._trace:
+                            self._log_line(['macro'], line)
+                        continue
 
                 # -------------------------------------------------------------
-                # Macro definition
-                if RE_MACRO.match(line):
-                    self._log_line(['macro'], line)
+                # Dispatch on the keyword
+                handler = KEYWORDS.get(kw)
+                if not handler and not line_indent:
+                    # 1st level keywords can be followed by any non-word
+                    # character, like 'endif#'
+                    st.regex += 1
+                    m = RE_BLOCK_KEYWORD.match(line)
+                    if m:
+                        handler = KEYWORDS[m.group(1)]
+                if handler and handler(self, st, line, line_indent, kw, arg):
                     continue
 
                 # -------------------------------------------------------------
-                # 'if' statement
-                m = RE_IF.match(line)
-                if m:
-                    self._log_line(['if'], line)
-                    self._if.append(m.group(1))
-                    continue
+                # Unprocessed lines
 
-                # 'endif' statement
-                if re.match(r'^endif\b', line):
-                    self._log_line(['endif'], line)
-                    self._if.pop()
-                    continue
+                self._log_line([st.token, 'ignored'], line, warning=True)
 
-                # -------------------------------------------------------------
-                # 'comment' found
-                if ((re.match(r'^\s*comment\s+"[^"]+"', line) or
-                     re.match(r"^comment\s+'[^']+'", line))):
-                    token = 'COMMENT'
-                    self._log_line([token], line)
-                    continue
+        # Help text that ends with the file
+        if st.token == 'CONFIG' and st.option == 'HELP' and \
+           st.help_start is not None:
+            st.records.append(('help_range', (st.help_start, st.help_end,
+                                              st.help_indent, False,
+                                              self._help_digest(data, st))))
 
-                if token == 'COMMENT':
-                    # Comment 'depends on' found
-                    if re.match(r'^\s*depends\s+on\s+', line):
-                        option = 'DEPENDS_ON'
-                        self._log_line([token, option], line)
-                        continue
+        if self.profile is not None:
+            self.profile.add_file(source, time.perf_counter() - start, lineno,
+                                  st.regex)
+        return st.records
 
-                # -------------------------------------------------------------
-                # 'menu' found
-                m = re.match(r'^\s*(main)?menu\s+"([^"]+)"', line)
-                if m:
-                    token = 'MENU'
-                    self._log_line([token], line)
-                    self._menu.append({
-                        'menu': m.group(2),
-                        'depends_on': [],
-                        'visible_if': [],
-                    })
-                    continue
+    @staticmethod
+    def _help_digest(data, st):
+        """
+        Return the content digest of the current help block, which tells
+        whether lazily loaded help texts changed without loading them
+        """
+        return hashlib.blake2b(data[st.help_start:st.help_end],
+                               digest_size=8).digest()
 
-                # 'endmenu' found
-                if re.match(r'^endmenu\b', line):
-                    token = 'ENDMENU'
-                    self._log_line([token], line)
-                    self._menu.pop()
-                    continue
+    @staticmethod
+    def _lines(data, st):
+        """
+        Return the decoded lines of the binary content of a file and keep
+        track of the byte offset
+        """
+        if data.isascii():
+            for line in io.StringIO(data.decode()):
+                st.offset += len(line)
+                yield line
+        else:
+            for line in io.BytesIO(data):
+                st.offset += len(line)
+                yield line.decode()
 
-                if token == 'MENU':
-                    # Menu 'depends on' found
-                    m = re.match(r'^\s*depends\s+on\s+(.*)$', line)
-                    if m:
-                        option = 'DEPENDS_ON'
-                        self._log_line([token, option], line)
-                        self._menu[-1]['depends_on'].append(m.group(1))
-                        continue
+    # -------------------------------------------------------------------------
+    # Keyword handlers, return True if the line was consumed
+
+    def _kw_source(self, st, line, _indent, _kw, arg):
+        # Source included Kconfig file
+        path = _quoted(arg)
+        if path is None:
+            return False
+        rest = arg[len(path) + 2:].lstrip()
+        if rest and rest[0] != '#':
+            return False
+        st.token = 'SOURCE'
+        st.option = 'NONE'
+        if self._trace:
+            self._log_line([st.token], line)
+        st.records.append(('source', path))
+        return True
+
+    def _kw_if(self, st, line, indent, _kw, arg):
+        # 'if' statement
+        if indent or arg is None:
+            return False
+        if self._trace:
+            self._log_line(['if'], line)
+        st.records.append(('if', arg))
+        return True
+
+    def _kw_endif(self, st, line, indent, _kw, _arg):
+        # 'endif' statement
+        if indent:
+            return False
+        if self._trace:
+            self._log_line(['endif'], line)
+        st.records.append(('endif', None))
+        return True
+
+    def _kw_comment(self, st, line, indent, _kw, arg):
+        # 'comment' found
+        if not arg:
+            return False
+        if arg[0] == "'" and indent:
+            return False
+        if arg.find(arg[0], 1) <= 1 or arg[0] not in ('"', "'"):
+            return False
+        st.token = 'COMMENT'
+        if self._trace:
+            self._log_line([st.token], line)
+        return True
+
+    def _kw_depends(self, st, line, _indent, _kw, arg):
+        # 'depends on' found
+        expr = _argument(arg, 'on')
+        if expr is None or st.token not in ('COMMENT', 'MENU', 'CHOICE',
+                                            'CONFIG'):
+            return False
+        st.option = 'DEPENDS_ON'
+        if self._trace:
+            self._log_line([st.token, st.option], line)
+        if st.token == 'MENU':
+            st.records.append(('menu_depends_on', expr))
+        elif st.token == 'CHOICE':
+            st.records.append(('choice_depends_on', expr))
+        elif st.token == 'CONFIG':
+            st.records.append(('depends_on', expr))
+        return True
+
+    def _kw_menu(self, st, line, _indent, _kw, arg):
+        # 'menu' or 'mainmenu' found
+        title = _quoted(arg)
+        if title is None:
+            return False
+        st.token = 'MENU'
+        if self._trace:
+            self._log_line([st.token], line)
+        st.records.append(('menu', title))
+        return True
+
+    def _kw_endmenu(self, st, line, indent, _kw, _arg):
+        # 'endmenu' found
+        if indent:
+            return False
+        st.token = 'ENDMENU'
+        if self._trace:
+            self._log_line([st.token], line)
+        st.records.append(('endmenu', None))
+        return True
+
+    def _kw_visible(self, st, line, _indent, _kw, arg):
+        # Menu 'visible if' found
+        expr = _argument(arg, 'if')
+        if expr is None or st.token != 'MENU':
+            return False
+        st.option = 'VISIBLE_IF'
+        if self._trace:
+            self._log_line([st.token, st.option], line)
+        st.records.append(('menu_visible_if', expr))
+        return True
+
+    def _kw_choice(self, st, line, indent, _kw, _arg):
+        # 'choice' found
+        if indent:
+            return False
+        st.token = 'CHOICE'
+        if self._trace:
+            self._log_line([st.token], line)
+        st.records.append(('choice', None))
+        return True
+
+    def _kw_endchoice(self, st, line, indent, _kw, _arg):
+        # 'endchoice' found
+        if indent:
+            return False
+        st.token = 'ENDCHOICE'
+        if self._trace:
+            self._log_line([st.token], line)
+        st.records.append(('endchoice', None))
+        return True
+
+    def _kw_config(self, st, line, _indent, _kw, _arg):
+        # 'config' or "menuconfig' definition
+        st.regex += 1
+        m = RE_CONFIG.match(line)
+        if not m:
+            return False
+        st.token = 'CONFIG'
+        if self._trace:
+            self._log_line([st.token], line)
+        st.records.append(('config', m.group(1)))
+        return True
+
+    def _kw_help(self, st, line, _indent, _kw, arg):
+        # Config or choice 'help' found
+        if arg is not None or st.token not in ('CHOICE', 'CONFIG'):
+            return False
+        st.option = 'HELP'
+        if self._trace:
+            self._log_line([st.token, st.option], line)
+        st.help_indent = 0
+        st.help_start = None
+        return True
+
+    def _kw_prompt(self, st, line, indent, _kw, arg):
+        # Config or choice 'prompt' found
+        prompt = _quoted(arg)
+        if prompt is None or st.token not in ('CHOICE', 'CONFIG'):
+            return False
+        if st.token == 'CHOICE':
+            if not indent:
+                return False
+            st.records.append(('choice_prompt', prompt))
+        else:
+            st.records.append(('prompt', prompt))
+        st.option = 'PROMPT'
+        if self._trace:
+            self._log_line([st.token, st.option], line)
+        return True
+
+    def _kw_type(self, st, line, _indent, kw, arg):
+        # Config or choice 'bool', 'string', 'int', 'tristate' or 'hex' found
+        if st.token == 'CHOICE':
+            st.records.append(('choice_type', (kw, arg)))
+        elif st.token == 'CONFIG':
+            st.records.append(('type', (kw, arg)))
+        else:
+            return False
+        st.option = 'TYPE'
+        if self._trace:
+            self._log_line([st.token, st.option], line)
+        return True
+
+    def _kw_default(self, st, line, _indent, kw, arg):
+        # Config 'def_bool', 'def_tristate' or 'default' or choice 'default'
+        # found
+        if arg is None:
+            return False
+        if st.token == 'CHOICE' and kw == 'default':
+            st.records.append(('choice_default', arg))
+        elif st.token == 'CONFIG':
+            st.records.append(('default', (kw, arg)))
+        else:
+            return False
+        st.option = 'DEFAULT'
+        if self._trace:
+            self._log_line([st.token, st.option], line)
+        return True
+
+    def _kw_option(self, st, line, _indent, kw, arg):
+        # Config 'select', 'range', 'option' or 'imply' found
+        if arg is None or st.token != 'CONFIG':
+            return False
+        st.option = kw.upper()
+        if self._trace:
+            self._log_line([st.token, st.option], line)
+        st.records.append((kw, arg))
+        return True
+
+    def _kw_modules(self, st, line, _indent, _kw, arg):
+        # Config 'modules' option found
+        if arg is not None or st.token != 'CONFIG':
+            return False
+        st.option = 'OPTION'
+        if self._trace:
+            self._log_line([st.token, st.option], line)
+        st.records.append(('option', 'modules'))
+        return True
+
+class _FileRecords():
+    """
+    The parsed records of Kconfig files and their (mtime, size) signatures,
+    indexed by the file path relative to the kernel source. The records don't
+    depend on the arch so the Kconfig trees of multiple arches can share them.
+    The records also don't depend on the file path, digests indexes them by
+    the content digest of their file (their first record).
+    """
+    def __init__(self):
+        self.files = {}
+        self.digests = {}
+        self.loaded = False
+        self.dirty = False
 
-                    # Menu 'visible if' found
-                    m = re.match(r'^\s*visible\s+if\s+(.*)$', line)
-                    if m:
-                        option = 'VISIBLE_IF'
-                        self._log_line([token, option], line)
-                        self._menu[-1]['visible_if'].append(m.group(1))
-                        continue
+    def get(self, source, signature):
+        """
+        Return the records of a file or None if they're missing or stale
+        """
+        cached = self.files.get(source)
+        if cached and cached[0] == signature:
+            return cached[1]
+        return None
 
-                # -------------------------------------------------------------
-                # 'choice' found
-                if re.match(r'^choice\b', line):
-                    token = 'CHOICE'
-                    self._log_line([token], line)
-                    self._choice.append({
-                        'prompt': '',
-                        'depends_on': [],
-                        'default': [],
-                        'type': [],
-                    })
-                    continue
+    def add(self, source, signature, records):
+        """
+        Add the records of a freshly parsed file. Files whose records didn't
+        change, like touched files, don't need to be saved again, they're
+        recognized by their digest the next time.
+        """
+        cached = self.files.get(source)
+        self.files[source] = (signature, records)
+        self.digests[records[0][1]] = records
+        if cached is None or cached[1] is not records:
+            self.dirty = True
 
-                # 'endchoice' found
-                if re.match(r'^endchoice\b', line):
-                    token = 'ENDCHOICE'
-                    self._log_line([token], line)
-                    self._choice.pop()
-                    continue
+    def clear(self):
+        """
+        Drop all records, the digests may be shared with another tree so
+        they're replaced rather than cleared
+        """
+        self.files = {}
+        self.digests = {}
+        self.loaded = False
+        self.dirty = False
 
-                if token == 'CHOICE':
-                    # Choice 'prompt' found
-                    m = re.match(r'^\s+prompt\s+"([^"]+)"', line)
-                    if m:
-                        option = 'PROMPT'
-                        self._log_line([token, option], line)
-                        self._choice[-1]['prompt'] = m.group(1)
-                        continue
+class _HelpLoader():
+    """
+    Materializes lazily loaded help texts from the byte ranges of their help
+    blocks in the memory-mapped Kconfig files. The most recently used texts
+    and files are kept.
+    """
+    def __init__(self, ksource):
+        self.ksource = ksource
+        self._texts = collections.OrderedDict()
+        self._files = collections.OrderedDict()
 
-                    # Choice 'depends on' found
-                    m = re.match(r'^\s*depends\s+on\s+(.*)$', line)
-                    if m:
-                        option = 'DEPENDS_ON'
-                        self._log_line([token, option], line)
-                        self._choice[-1]['depends_on'].append(m.group(1))
-                        continue
+    def __getstate__(self):
+        # Don't pickle the cached texts and the file mappings
+        return {'ksource': self.ksource}
 
-                    # Choice 'default' found
-                    m = re.match(r'^\s*default\s+(.*)$', line)
-                    if m:
-                        option = 'DEFAULT'
-                        self._log_line([token, option], line)
-                        self._choice[-1]['default'].append(m.group(1))
-                        continue
+    def __setstate__(self, state):
+        self.__init__(state['ksource'])
 
-                    # Choice 'help' found
-                    if re.match(r'^\s*(---)?help(---)?\s*$', line):
-                        option = 'HELP'
-                        self._log_line([token, option], line)
-                        help_indent = 0
+    def _mmap(self, source):
+        """
+        Return the (cached) memory map of a Kconfig file
+        """
+        data = self._files.get(source)
+        if data is not None:
+            self._files.move_to_end(source)
+            return data
+
+        with open(os.path.join(self.ksource, source), 'rb') as fh:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._files[source] = data
+        if len(self._files) > HELP_FILES_SIZE:
+            self._files.popitem(last=False)[1].close()
+        return data
+
+    def invalidate(self, sources):
+        """
+        Drop the cached texts and memory maps of the provided Kconfig files
+        """
+        for source in sources:
+            data = self._files.pop(source, None)
+            if data is not None:
+                data.close()
+        for ranges in list(self._texts):
+            if any(r[0] in sources for r in ranges):
+                del self._texts[ranges]
+
+    def load(self, ranges):
+        """
+        Return the help text of the provided (source, start, end, indent,
+        strip, digest) byte ranges as a tuple of lines
+        """
+        text = self._texts.get(ranges)
+        if text is not None:
+            self._texts.move_to_end(ranges)
+            return text
+
+        lines = []
+        for source, start, end, indent, strip, _digest in ranges:
+            data = self._mmap(source)[start:end]
+            lines.extend(line[indent:] for line in
+                         read_line(line.decode() for line in io.BytesIO(data)))
+            # Remove trailing empty lines of help texts that end before the
+            # end of the file
+            if strip:
+                while not lines[-1]:
+                    del lines[-1]
+
+        text = tuple(lines)
+        self._texts[ranges] = text
+        if len(self._texts) > HELP_CACHE_SIZE:
+            self._texts.popitem(last=False)
+        return text
+
+class ParseProfile():
+    """
+    Parse statistics of a Kconfig tree: the wall time and number of lines of
+    every parsed file, the number of lines per parser branch and the number of
+    regex evaluations. Files whose records were parsed before, by the tree of
+    another arch or for a file with the same content, are counted as cached.
+    """
+    def __init__(self):
+        self.total = 0.0
+        self.files = {}
+        self.cached = []
+        self.branches = collections.Counter()
+        self.regex = 0
+
+    def add_file(self, source, elapsed, lines, regex):
+        """
+        Add the statistics of a parsed file
+        """
+        self.files[source] = (elapsed, lines)
+        self.regex += regex
+
+    def add_cached(self, source):
+        """
+        Add a file whose records were reused without parsing it
+        """
+        self.cached.append(source)
+
+    def ignored(self):
+        """
+        Return the number of lines that were ignored with a warning
+        """
+        return sum(count for branch, count in self.branches.items()
+                   if branch.endswith(':ignored'))
+
+    def to_dict(self):
+        """
+        Return the statistics as a dict, the files ranked by wall time
+        """
+        return {
+            'total': round(self.total, 6),
+            'lines': sum(lines for _elapsed, lines in self.files.values()),
+            'regex': self.regex,
+            'ignored': self.ignored(),
+            'files': [{'file': source, 'time': round(elapsed, 6),
+                       'lines': lines} for source, (elapsed, lines) in
+                      sorted(self.files.items(), key=lambda f: -f[1][0])],
+            'cached': sorted(self.cached),
+            'branches': dict(self.branches.most_common()),
+        }
+
+    def report(self, fh, top=20):
+        """
+        Write a report with the slowest files and the line counts per branch
+        """
+        data = self.to_dict()
+        fh.write('Parsed {} files, {} lines in {:.3f}s, {} regex evaluations, '
+                 '{} ignored lines\n'.format(len(data['files']),
+                                             data['lines'], data['total'],
+                                             data['regex'], data['ignored']))
+        if data['cached']:
+            fh.write('Reused the records of {} cached files\n'.format(
+                len(data['cached'])))
+        fh.write('\nSlowest files:\n')
+        for f in data['files'][:top]:
+            fh.write('  {:9.6f}s {:6} lines  {}\n'.format(f['time'],
+                                                           f['lines'],
+                                                           f['file']))
+        fh.write('\nLines per branch:\n')
+        for branch, count in data['branches'].items():
+            fh.write('  {:8}  {}\n'.format(count, branch))
+
+class _MakefileIndex():
+    """
+    Follows the directories that kbuild descends into, starting at the top
+    level Makefile, and indexes the objects of their Kbuild files (or
+    Makefiles). Variable references and the functions in MAKE_FUNCTIONS are
+    expanded like make does, with all conditional assignments like
+    'machine-$(CONFIG_FOO) += foo' taken as enabled.
+    """
+    def __init__(self, ksource, srcarch, tristates):
+        self.ksource = ksource
+        self.srcarch = srcarch
+        self.tristates = tristates
+
+        # The Makefiles and Kbuild files that were read, the directories
+        # mapped to the symbols that gate them (None for unconditional
+        # directories), the objects mapped to the symbols that enable them
+        # and the symbols mapped to the kernel modules they enable
+        self.makefiles = []
+        self.dirs = {}
+        self.objects = {}
+        self.modules = {}
+
+        # The directories to descend into (None while walking a tree) and the
+        # files that were read
+        self._queue = collections.deque()
+        self._seen = set()
+
+    def run(self):
+        """
+        Index the tree from the top level Makefile, which includes the arch
+        Makefile, and the top level Kbuild file. Trees without them are
+        walked instead.
+        """
+        seeds = [f for f in ('Makefile', 'Kbuild') if
+                 os.path.isfile(os.path.join(self.ksource, f))]
+        if not seeds:
+            self._queue = None
+            for f in self._walk():
+                self.read(f, os.path.dirname(f), {})
+            return
+
+        variables = {}
+        for f in ('Makefile', os.path.join('arch', self.srcarch, 'Makefile')):
+            if f not in self._seen and \
+               os.path.isfile(os.path.join(self.ksource, f)):
+                self.read(f, '', variables)
+        if 'Kbuild' in seeds:
+            self.read('Kbuild', '', {})
+
+        while self._queue:
+            # kbuild reads the Kbuild file of a directory and falls back to
+            # its Makefile
+            path = self._queue.popleft()
+            for f in (os.path.join(path, 'Kbuild'),
+                      os.path.join(path, 'Makefile')):
+                if os.path.isfile(os.path.join(self.ksource, f)):
+                    self.read(f, path, {})
+                    break
+
+    def _walk(self):
+        """
+        Find all Makefiles and Kbuild files, skipping hidden directories, the
+        other architectures and the directories in MAKEFILE_PRUNE
+        """
+        result = []
+        stack = ['']
+        while stack:
+            path = stack.pop()
+            with os.scandir(os.path.join(self.ksource, path)) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
                         continue
+                    if entry.is_dir(follow_symlinks=False):
+                        if ((path == 'arch' and entry.name != self.srcarch or
+                             not path and entry.name in MAKEFILE_PRUNE)):
+                            continue
+                        stack.append(os.path.join(path, entry.name))
+                    elif entry.name in ('Makefile', 'Kbuild'):
+                        result.append(os.path.join(path, entry.name))
+        return sorted(result)
 
-                    # Choice 'bool', 'string', 'int', 'tristate' or 'hex' found
-                    m = re.match(r'^\s*(bool|string|int|tristate|hex)(|\s+(.*))$',
-                                 line)
+    def read(self, f, src, variables):
+        """
+        Index a Makefile or Kbuild file of the directory src. variables maps
+        the make variables to the lists of their raw values, shared with the
+        files that include it.
+        """
+        self.makefiles.append(f)
+        self._seen.add(f)
+
+        with open(os.path.join(self.ksource, f)) as fh:
+            for line in read_line(fh):
+                m = RE_MAKEFILE_ASSIGN.match(line)
+                if not m:
+                    # Included Makefiles and directories that are built from
+                    # recipes
+                    m = RE_MAKEFILE_INCLUDE.match(line)
                     if m:
-                        option = 'TYPE'
-                        self._log_line([token, option], line)
-                        self._choice[-1]['type'].append({
-                            m.group(1): m.group(3),
-                        })
-                        continue
+                        for g in self._expand(m.group(1), src,
+                                              variables).split():
+                            self._include(g, src, variables)
+                    elif '$(build)=' in line:
+                        for m in RE_MAKEFILE_BUILD.finditer(line):
+                            self._descend(self._expand(
+                                m.group(1), src, variables).rstrip('/') + '/',
+                                          '', None)
+                    continue
 
-                # -------------------------------------------------------------
-                # 'config' or "menuconfig' definition
-                m = RE_CONFIG.match(line)
+                target, op, value = m.groups()
+                name = RE_MAKEFILE_COND.sub('-y', target) if '$' in target \
+                    else target
+                if op == '+=' and name in variables:
+                    variables[name].append(value)
+                elif op != '?=' or name not in variables:
+                    variables[name] = [value]
+
+                m = RE_MAKEFILE_DIRS.match(target)
+                if m and ('/' in value or '$' in value):
+                    var, cond = m.groups()
+                    gate = None
+                    if cond not in ('y', 'm'):
+                        gate = RE_MAKEFILE_GATE.search(cond)
+                        gate = gate.group(1) if gate else None
+                    self._descend(self._expand(value, src, variables),
+                                  src if var in ('obj', 'subdir') else '',
+                                  gate)
+
+                m = RE_MAKEFILE_OBJ.match(target)
                 if m:
-                    token = 'CONFIG'
-                    self._log_line([token], line)
-                    name = m.group(1)
-                    # Initialize the config data hash
-                    if name not in self.symbols:
-                        self.symbols[name] = {
-                            'name': name,
-                            'kconfig': [],
-                            'help': [],
-                            'depends_on': [],
-                            'select': [],
-                            'type': [],
-                            'default': [],
-                            'range': [],
-                            'option': [],
-                            'imply': [],
-                            'prompt': [],
-                            'if': self._if.copy(),
-                            'menu': self._menu.copy(),
-                            'choice': self._choice.copy(),
-                        }
-                    # Add the Kconfig file that references this option
-                    self.symbols[name]['kconfig'].append(kconfig)
+                    self._add_objects(m.group(1), value, src)
+
+    def _include(self, f, src, variables):
+        """
+        Read an included Makefile or Kbuild file, like the ones of the
+        subdirectories of drivers that are built into a single module
+        """
+        f = os.path.normpath(f)
+        if os.path.basename(f) not in ('Makefile', 'Kbuild') or \
+           f.startswith('..') or f in self._seen or \
+           not os.path.isfile(os.path.join(self.ksource, f)):
+            return
+        self.read(f, src, variables)
+
+    def _descend(self, value, base, gate):
+        """
+        Record the subdirectories in value, relative to base, and queue the
+        ones that weren't seen before
+        """
+        for d in value.split():
+            if not d.endswith('/') or MAKE_UNDEFINED in d:
+                continue
+            d = os.path.normpath(os.path.join(base, d))
+            if d in self.dirs or d.startswith('..') or d == '.':
+                continue
+            self.dirs[d] = gate
+            if self._queue is not None:
+                self._queue.append(d)
+
+    def _add_objects(self, symbol, value, src):
+        """
+        Index the objects that symbol enables
+        """
+        symbol_modules = self.modules.setdefault(symbol, [])
+        for g in value.split(' '):
+            if g.endswith('.o'):
+                # The first Makefile that references the object wins, unless
+                # only a later tristate symbol can build it as a module
+                obj = os.path.basename(g[:-2]).replace('-', '_')
+                if obj not in self.objects or \
+                   (symbol in self.tristates and
+                    self.objects[obj] not in self.tristates):
+                    self.objects[obj] = symbol
+                symbol_modules.append(os.path.join(src,
+                                                   g.replace('.o', '.ko')))
+
+    def _expand(self, value, src, variables, depth=0):
+        """
+        Expand the variable references and function calls of a make value.
+        Undefined variables and unsupported functions expand to
+        MAKE_UNDEFINED, which marks the words that can't be resolved.
+        """
+        result = []
+        pos = 0
+        while True:
+            start = value.find('$(', pos)
+            if start == -1:
+                result.append(value[pos:])
+                break
+            result.append(value[pos:start])
+
+            # Find the closing parenthesis
+            level = 0
+            for end in range(start + 1, len(value)):
+                if value[end] == '(':
+                    level += 1
+                elif value[end] == ')':
+                    level -= 1
+                    if not level:
+                        break
+            else:
+                result.append(MAKE_UNDEFINED)
+                break
+            result.append(self._call(value[start + 2:end], src, variables,
+                                     depth))
+            pos = end + 1
+        return ''.join(result)
+
+    def _call(self, expr, src, variables, depth):
+        """
+        Return the value of a variable reference or function call
+        """
+        if depth > 16:
+            return MAKE_UNDEFINED
+        func, _, args = expr.partition(' ')
+        if args and func in MAKE_FUNCTIONS:
+            # Split the arguments on the top level commas
+            parts = ['']
+            level = 0
+            for c in args:
+                if c == ',' and not level:
+                    parts.append('')
                     continue
+                level += (c == '(') - (c == ')')
+                parts[-1] += c
+            if len(parts) != MAKE_FUNCTIONS[func]:
+                return MAKE_UNDEFINED
+            parts = [self._expand(p, src, variables, depth + 1)
+                     for p in parts]
+            if func == 'addprefix':
+                return ' '.join(parts[0].strip() + w for w in
+                                parts[1].split())
+            if func == 'addsuffix':
+                return ' '.join(w + parts[0].strip() for w in
+                                parts[1].split())
+            if func == 'patsubst':
+                prefix, _, suffix = parts[0].strip().partition('%')
+                new = parts[1].strip()
+                return ' '.join(
+                    new.replace('%', w[len(prefix):len(w) - len(suffix)], 1)
+                    if w.startswith(prefix) and w.endswith(suffix) else w
+                    for w in parts[2].split())
+            if func == 'sort':
+                return ' '.join(sorted(set(parts[0].split())))
+            if func == 'strip':
+                return ' '.join(parts[0].split())
+            return parts[2].replace(parts[0], parts[1])
+
+        name = self._expand(expr, src, variables, depth + 1)
+        if name in ('src', 'obj'):
+            return src or '.'
+        if name in ('srctree', 'objtree'):
+            return '.'
+        if name == 'SRCARCH':
+            return self.srcarch
+        if name.startswith('CONFIG_'):
+            return 'y'
+        if name not in variables:
+            return MAKE_UNDEFINED
+        return self._expand(' '.join(variables[name]), src, variables,
+                            depth + 1)
 
-                if token == 'CONFIG':
-                    # Config 'help' found
-                    if re.match(r'^\s*(---)?help(---)?\s*$', line):
-                        option = 'HELP'
-                        self._log_line([token, option], line)
-                        help_indent = 0
-                        continue
+def cache_dir(ksource):
+    """
+    Return the parse cache directory of a kernel source tree. The caches are
+    pickles, so they're kept in the user's own cache directory
+    ($XDG_CACHE_HOME) rather than in the possibly shared kernel source.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    path = os.path.realpath(ksource)
+    return os.path.join(base, CACHE_DIR, '{}-{}'.format(
+        os.path.basename(path), hashlib.blake2b(
+            path.encode(), digest_size=8).hexdigest()))
 
-                    # Config 'depends on' found
-                    m = re.match(r'^\s*depends\s+on\s+(.*)$', line)
-                    if m:
-                        option = 'DEPENDS_ON'
-                        self._log_line([token, option], line)
-                        self.symbols[name]['depends_on'].append(m.group(1))
-                        continue
+class Kconfig():
+    def __init__(self, ksource, kconfig, arch, log_level=logging.INFO,
+                 test=False, cache=False, rebuild_cache=False, jobs=1,
+                 records=None, lazy_help=False, profile=False, reference=None,
+                 keep_records=False):
+        self.ksource = ksource
+        self.kconfig = kconfig
+        self.arch = arch
+        self.test = test
+        self.jobs = jobs
+        self.symbols = {}
 
-                    # Config 'select' found
-                    m = re.match(r'^\s*select\s+(.*)$', line)
-                    if m:
-                        option = 'SELECT'
-                        self._log_line([token, option], line)
-                        self.symbols[name]['select'].append(m.group(1))
-                        continue
+        # Parse statistics, profiling parses all files sequentially and
+        # bypasses the on-disk cache so that every file is timed
+        self.profile = ParseProfile() if profile else None
 
-                    # Config 'bool', 'string', 'int', 'tristate' or 'hex' found
-                    m = re.match(r'^\s*(bool|string|int|tristate|hex)(|\s+(.*))$',
-                                 line)
-                    if m:
-                        option = 'TYPE'
-                        self._log_line([token, option], line)
-                        self.symbols[name]['type'].append({
-                            m.group(1): m.group(3),
-                        })
-                        continue
+        # Lazy help texts only record the byte ranges of the help blocks and
+        # load the texts on access
+        self._help_loader = _HelpLoader(ksource) if lazy_help else None
 
-                    # Config 'def_bool', 'def_tristate' or 'default' found
-                    m = re.match(r'^\s*(def_bool|def_tristate|default)\s+(.*)$',
-                                 line)
-                    if m:
-                        option = 'DEFAULT'
-                        self._log_line([token, option], line)
-                        self.symbols[name]['default'].append({
-                            m.group(1): m.group(2),
-                        })
-                        continue
+        # Setup the logger
+        logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s',
+                            datefmt='%Y-%m-%d %H:%M:%S',
+                            level=log_level)
+        self._log = logging.getLogger(__name__)
 
-                    # Config 'range' found
-                    m = re.match(r'^\s*range\s+(.*)$', line)
-                    if m:
-                        option = 'RANGE'
-                        self._log_line([token, option], line)
-                        self.symbols[name]['range'].append(m.group(1))
-                        continue
+        # The single Kconfig file parser
+        self._reader = _Reader(self.ksource, self._log, test=test,
+                               profile=self.profile, lazy_help=lazy_help)
 
-                    # Config 'option' found
-                    m = re.match(r'^\s*option\s+(.*)$', line)
-                    if m:
-                        option = 'OPTION'
-                        self._log_line([token, option], line)
-                        self.symbols[name]['option'].append(m.group(1))
-                        continue
+        # The list of the Makefiles and Kbuild files reachable from the top
+        # level Makefile and the directories they descend into, mapped to the
+        # symbols that gate them (None for unconditional directories)
+        self._makefiles = []
+        self._dirs = {}
 
-                    # Config 'modules' option found
-                    m = re.match(r'^\s*modules$', line)
-                    if m:
-                        option = 'OPTION'
-                        self._log_line([token, option], line)
-                        self.symbols[name]['option'].append('modules')
+        # Makefile object index, maps object names (with '-' replaced by '_')
+        # to the symbols that enable them and symbols to the kernel modules
+        # they enable
+        self._objects = None
+        self._modules = None
+
+        # Help search index, maps words of the prompts, menu titles and help
+        # texts to the weights of the symbols that contain them
+        self._search = None
+        self._search_words = None
+
+        # 'if' conditions
+        self._if = ()
+
+        # 'menu' conditions
+        self._menu = ()
+
+        # 'choice' conditions
+        self._choice = ()
+
+        # The opt-in on-disk parse cache, the test and profile modes need to
+        # see every line so they bypass the cache
+        self._cache = cache and not test and not profile
+        self._cache_dir = cache_dir(self.ksource)
+
+        # Parsed records of the Kconfig files, optionally shared with other
+        # Kconfig instances. They're dropped once the tree is built unless
+        # they're kept for fast reloads and reference trees, or shared and
+        # thus owned by the caller.
+        self._files = _FileRecords() if records is None else records
+        self._keep_records = keep_records or records is not None
+
+        # Reuse the records of the files of a reference tree, like another
+        # kernel version, for files with the same content
+        if reference is not None:
+            self._files.digests = reference._files.digests
+
+        # (mtime, size) signatures and content digests of the Kconfig files
+        # of this tree
+        self._signatures = {}
+        self._digests = {}
+
+        # Reverse dependency indexes, map symbol names to the names of the
+        # symbols that reference them (see RDEPS)
+        self._rdeps = {}
+
+        # Restricts the replay of the parsed records to the symbols in _only
+        # while reloading changed files (see reload). The order of the symbol
+        # definitions is collected in _order, the options of the other
+        # symbols are skipped with the placeholder _sink symbol.
+        self._only = None
+        self._order = None
+        self._sink = None
+
+        # The type and default dicts of the symbols that are being parsed,
+        # keyed by their (keyword, value) records so that equal options share
+        # them
+        self._entries = {}
+
+        # The sourced Kconfig files whose blocks (including the blocks of the
+        # files they source) don't end in the file, see reload
+        self._unbalanced = set()
+
+        # Parse the Kconfig tree, _kconfigs maps the parsed Kconfig files to
+        # the files that sourced them
+        self._kconfigs = {}
+        if self._cache and not rebuild_cache and self._load_tree_cache():
+            return
+        if self._cache and not rebuild_cache:
+            self._load_file_cache()
+        if self.profile is not None:
+            start = time.perf_counter()
+        if self.jobs > 1 and not self.test and not profile:
+            self._parse_parallel()
+        self._build()
+        if self.profile is not None:
+            self.profile.total = time.perf_counter() - start
+        if self._cache:
+            self._save_cache()
+        self._drop_records()
+
+    def _index_makefiles(self):
+        """
+        Scan the Makefiles and Kbuild files once, following the
+        subdirectories they reference, and build the object index
+        """
+        if self._objects is not None:
+            return
+
+        self._log.debug('Index Makefiles and Kbuild files')
+
+        tristates = {name for name, symbol in self.symbols.items()
+                     if any('tristate' in t for t in symbol['type'])}
+        index = _MakefileIndex(self.ksource, SRCARCH.get(self.arch, self.arch),
+                               tristates)
+        index.run()
+
+        self._makefiles = index.makefiles
+        self._dirs = index.dirs
+        self._objects = index.objects
+        self._modules = index.modules
+
+    def _search_cache_file(self):
+        """
+        Return the cache file that holds the help search index of the tree
+        """
+        return os.path.join(self._cache_dir, 'search-{}-{}.pickle'.format(
+            SRCARCH.get(self.arch, self.arch), self.kconfig.replace('/', '_')))
+
+    def _index_search(self):
+        """
+        Build the help search index once or load it from the cache
+        """
+        if self._search is not None:
+            return
+
+        cache_file = self._search_cache_file()
+        data = self._read_cache(cache_file) if self._cache else None
+        if data and data['signatures'] == self._signatures:
+            self._search = data['index']
+        else:
+            self._log.debug('Index help texts')
+            index = {}
+            for name, symbol in self.symbols.items():
+                weights = {}
+                for text, weight in _search_texts(symbol):
+                    words = collections.Counter(
+                        RE_SEARCH_WORD.findall(text.lower()))
+                    for word, count in words.items():
+                        weights[word] = weights.get(word, 0) + count * weight
+                for word, weight in weights.items():
+                    index.setdefault(word, {})[name] = weight
+            self._search = index
+            if self._cache:
+                self._write_cache(cache_file, {
+                    'signatures': self._signatures,
+                    'index': index,
+                })
+        self._search_words = sorted(self._search)
+
+    def _search_postings(self, word, prefix):
+        """
+        Return the tf-idf scores of the symbols that contain the provided word
+        or, for prefix searches, any word that starts with it
+        """
+        if prefix:
+            pos = bisect.bisect_left(self._search_words, word)
+            words = []
+            while pos < len(self._search_words) and \
+                  self._search_words[pos].startswith(word):
+                words.append(self._search_words[pos])
+                pos += 1
+        else:
+            words = [word] if word in self._search else []
+
+        scores = {}
+        for w in words:
+            posting = self._search[w]
+            idf = math.log(1 + len(self.symbols) / len(posting))
+            if not scores:
+                scores = {name: weight * idf for name, weight in
+                          posting.items()}
+                continue
+            for name, weight in posting.items():
+                scores[name] = scores.get(name, 0) + weight * idf
+        return scores
+
+    # -------------------------------------------------------------------------
+    # Parse cache
+
+    def _tree_cache_file(self):
+        """
+        Return the cache file that holds the parsed symbols of the tree
+        """
+        return os.path.join(self._cache_dir, 'tree-{}-{}{}.pickle'.format(
+            SRCARCH.get(self.arch, self.arch), self.kconfig.replace('/', '_'),
+            '-lazy' if self._help_loader else ''))
+
+    def _files_cache_file(self):
+        """
+        Return the cache file that holds the records of the individual
+        Kconfig files, which lack the help lines with lazy help
+        """
+        return os.path.join(self._cache_dir, 'files{}.pickle'.format(
+            '-lazy' if self._help_loader else ''))
+
+    def _read_cache(self, cache_file):
+        """
+        Return the content of a cache file or None if it's missing, unreadable
+        or from a different parser version
+        """
+        try:
+            with open(cache_file, 'rb') as fh, _paused_gc():
+                data = pickle.load(fh)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            self._log.warning('Failed to read cache file %s: %s', cache_file, e)
+            return None
+        if data.get('version') != PARSER_VERSION:
+            return None
+        return data
+
+    def _write_cache(self, cache_file, data):
+        """
+        Atomically write a cache file
+        """
+        data['version'] = PARSER_VERSION
+        tmp_file = '{}.{}'.format(cache_file, os.getpid())
+        try:
+            os.makedirs(self._cache_dir, mode=0o700, exist_ok=True)
+            with open(tmp_file, 'wb') as fh:
+                pickle.dump(data, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            self._log.warning('Failed to write cache file %s: %s', cache_file, e)
+
+    def _signature(self, source):
+        """
+        Return the (mtime, size) signature of a Kconfig file
+        """
+        st = os.stat(os.path.join(self.ksource, source))
+        return (st.st_mtime_ns, st.st_size)
+
+    def _load_tree_cache(self):
+        """
+        Load the symbols of the whole tree from the cache and reload the
+        Kconfig files that changed since
+        """
+        data = self._read_cache(self._tree_cache_file())
+        if not data:
+            return False
+
+        self._log.debug('Load symbols from cache')
+        self.symbols = data['symbols']
+        if self._help_loader:
+            for symbol in self.symbols.values():
+                symbol.loader = self._help_loader
+        self._kconfigs = data['kconfigs']
+        self._signatures = data['signatures']
+        self._digests = data['digests']
+        self._rdeps = data['rdeps']
+        self._unbalanced = data['unbalanced']
+        if self.stale():
+            self._log.debug('Reload the changed files of the cached tree')
+            self.reload()
+        return True
+
+    def _load_file_cache(self):
+        """
+        Load the cached records of the individual Kconfig files
+        """
+        if self._files.loaded:
+            return
+        self._files.loaded = True
+        data = self._read_cache(self._files_cache_file())
+        if data:
+            data['files'].update(self._files.files)
+            self._files.files = data['files']
+            for _signature, records in data['files'].values():
+                self._files.digests.setdefault(records[0][1], records)
+
+    def _save_cache(self):
+        """
+        Save the records of the individual Kconfig files and the symbols of the
+        whole tree
+        """
+        if self._files.dirty:
+            self._write_cache(self._files_cache_file(),
+                              {'files': self._files.files})
+            self._files.dirty = False
+
+        self._write_cache(self._tree_cache_file(), {
+            'symbols': self.symbols,
+            'kconfigs': self._kconfigs,
+            'signatures': self._signatures,
+            'digests': self._digests,
+            'rdeps': self._rdeps,
+            'unbalanced': self._unbalanced,
+        })
+
+    # -------------------------------------------------------------------------
+    # Kconfig parser
+
+    def _drop_records(self):
+        """
+        Drop the parsed records of the Kconfig files unless they're kept
+        """
+        if not self._keep_records:
+            self._files.clear()
+
+    def _get_records(self, source, force=False):
+        """
+        Return the parsed records of a Kconfig file, either from the cache or
+        by parsing the file
+        """
+        signature = self._signature(source)
+        records = None if force else self._files.get(source, signature)
+        if records is None:
+            records = self._reader.read(source, self._files.digests)
+            self._files.add(source, signature, records)
+        elif self.profile is not None:
+            self.profile.add_cached(source)
+        self._signatures[source] = signature
+        return records
+
+    def _parse_parallel(self):
+        """
+        Discover the graph of sourced Kconfig files and parse the files that
+        are not cached in a pool of worker processes. _parse_kconfig then
+        replays the records in the same order as in sequential mode.
+        """
+        root = self.source_path(self.kconfig)
+        queue = [root]
+        seen = {root}
+        futures = {}
+
+        with concurrent.futures.ProcessPoolExecutor(self.jobs) as pool:
+            while queue or futures:
+                # Submit newly discovered files, follow the sources of cached
+                # files right away
+                while queue:
+                    source = queue.pop()
+                    try:
+                        signature = self._signature(source)
+                    except OSError:
+                        # Leave the error reporting to _parse_kconfig
                         continue
+                    records = self._files.get(source, signature)
+                    if records is not None:
+                        queue.extend(self._new_sources(records, seen))
+                    else:
+                        future = pool.submit(self._reader.read, source)
+                        futures[future] = (source, signature)
+
+                if not futures:
+                    break
 
-                    # Config 'imply' found
-                    m = re.match(r'^\s*imply\s+(.*)$', line)
-                    if m:
-                        option = 'IMPLY'
-                        self._log_line([token, option], line)
-                        self.symbols[name]['imply'].append(m.group(1))
+                done, _pending = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    source, signature = futures.pop(future)
+                    if future.exception():
+                        # Leave the error reporting to _parse_kconfig
                         continue
+                    records = future.result()
+                    self._files.add(source, signature, records)
+                    queue.extend(self._new_sources(records, seen))
 
-                    # Config 'prompt' found
-                    m = re.match(r'^\s*prompt\s+"([^"]+)"', line)
-                    if m:
-                        option = 'PROMPT'
-                        self._log_line([token, option], line)
-                        self.symbols[name]['prompt'].append(m.group(1))
+    def _new_sources(self, records, seen):
+        """
+        Return the Kconfig files sourced by the provided records that are not
+        in seen yet and add them to seen
+        """
+        result = []
+        for op, val in records:
+            if op == 'source':
+                source = self.source_path(val)
+                if source not in seen:
+                    seen.add(source)
+                    result.append(source)
+        return result
+
+    def _parse_kconfig(self, kconfig, parent=None):
+        """
+        Parse the provided kconfig file and recursively traverse all included
+        kconfig files as well.
+        """
+        # Prevent reading the same Kconfig multiple times
+        if kconfig in self._kconfigs:
+            return
+        self._kconfigs[kconfig] = parent
+
+        # Replay the parsed records of the file
+        source = self.source_path(kconfig)
+        lazy = self._help_loader is not None
+        only = self._only
+        sink = self._sink
+        entries = self._entries
+        depth = (len(self._if), len(self._menu), len(self._choice))
+        symbol = None
+        for op, val in self._get_records(source):
+            # Source included Kconfig file
+            if op == 'source':
+                self._parse_kconfig(val, kconfig)
+
+            # 'config' or "menuconfig' definition
+            elif op == 'config':
+                if only is not None:
+                    self._order.append(val)
+                    if val not in only:
+                        symbol = sink
                         continue
+                symbol = self.symbols.get(val)
+                if symbol is None:
+                    symbol = Symbol(sys.intern(val), self._if, self._menu,
+                                    self._choice, self._help_loader)
+                    self.symbols[val] = symbol
+                # Add the Kconfig file that references this option
+                symbol.kconfig.append(kconfig)
+
+            # Options of the symbols that aren't reloaded
+            elif symbol is sink and op in SYMBOL_RECORDS:
+                continue
+
+            # Config 'type' and 'default' options, equal options share their
+            # dict
+            elif op in ('type', 'default'):
+                entry = entries.get(val)
+                if entry is None:
+                    entry = entries[val] = {val[0]: val[1]}
+                getattr(symbol, op).append(entry)
+
+            # Config help lines and the end of config help (remove trailing
+            # empty lines), or only the byte range of the help for lazy help.
+            # The lazy reader doesn't record the help lines, but records
+            # can come from a reference tree.
+            elif op == 'help':
+                if not lazy:
+                    symbol.help.append(sys.intern(val))
+            elif op == 'help_end':
+                if not lazy:
+                    while not symbol.help[-1]:
+                        del symbol.help[-1]
+            elif op == 'help_range':
+                if lazy:
+                    symbol.help.append((source,) + val)
+
+            # Config 'depends_on', 'select', 'range', 'option', 'imply' and
+            # 'prompt' options
+            elif op in SYMBOL_OPTIONS:
+                getattr(symbol, op).append(_intern(val))
+
+            # 'if' and 'endif' statements. The contexts are immutable tuples
+            # so that symbols with the same nesting share them.
+            elif op == 'if':
+                self._if = self._if + (_intern(val),)
+            elif op == 'endif':
+                self._if = self._if[:-1]
+
+            # 'menu' and 'endmenu' statements and menu options
+            elif op == 'menu':
+                self._menu = self._menu + ({
+                    'menu': val,
+                    'depends_on': [],
+                    'visible_if': [],
+                },)
+            elif op == 'endmenu':
+                self._menu = self._menu[:-1]
+            elif op == 'menu_depends_on':
+                self._menu[-1]['depends_on'].append(_intern(val))
+            elif op == 'menu_visible_if':
+                self._menu[-1]['visible_if'].append(_intern(val))
+
+            # 'choice' and 'endchoice' statements and choice options
+            elif op == 'choice':
+                self._choice = self._choice + ({
+                    'prompt': '',
+                    'depends_on': [],
+                    'default': [],
+                    'type': [],
+                },)
+            elif op == 'endchoice':
+                self._choice = self._choice[:-1]
+            elif op == 'choice_prompt':
+                self._choice[-1]['prompt'] = val
+            elif op == 'choice_type':
+                self._choice[-1]['type'].append({val[0]: val[1]})
+            elif op in ('choice_depends_on', 'choice_default'):
+                self._choice[-1][op[7:]].append(_intern(val))
+
+            # Content digest of the file
+            elif op == 'digest':
+                self._digests[source] = val
+
+        # Blocks that span multiple files leak their conditions into the
+        # following files, which a reload can't track. The main menu of the
+        # top level Kconfig file is never closed.
+        if parent is not None and \
+           depth != (len(self._if), len(self._menu), len(self._choice)):
+            self._unbalanced.add(kconfig)
+
+    def _build(self):
+        """
+        Parse the whole Kconfig tree into frozen and indexed symbols, with the
+        garbage collector paused as the parsed records and symbols don't form
+        cycles
+        """
+        with _paused_gc():
+            self._parse_kconfig(self.kconfig)
+            self._freeze_symbols()
+            self._index_rdeps()
 
-                # -------------------------------------------------------------
-                # Unprocessed lines
+    def _freeze_symbols(self, symbols=None):
+        """
+        Freeze the parsed symbols, by default all of them, into their compact
+        form
+        """
+        contexts = set()
+        if symbols is None:
+            symbols = self.symbols.values()
+        for symbol in symbols:
+            symbol.freeze()
+
+            # The menu and choice dicts are shared by all their symbols
+            for context in (symbol.menu, symbol.choice):
+                if id(context) in contexts:
+                    continue
+                contexts.add(id(context))
+                for data in context:
+                    for key, val in data.items():
+                        if isinstance(val, list):
+                            data[key] = tuple(val)
 
-                if line:
-                    self._log_line([token, 'ignored'], line, warning=True)
+        # The frozen symbols keep their dicts, drop the lookup table
+        self._entries = {}
 
-    def _search_symbols(self, key, vals):
+    def _index_rdeps(self):
         """
-        Search and return symbols containing key 'key' with any value of 'vals'
+        Build the reverse dependency indexes from the symbol expressions. For
+        'select' and 'imply' only the selected or implied symbol is indexed,
+        not the symbols of a trailing 'if' condition.
         """
-        result = {}
+        self._rdeps = {key: {} for key in RDEPS}
         for name, symbol in self.symbols.items():
-            svals = symbol[key]
-            for sval in svals:
-                for val in vals:
-                    if re.match(r'\b{}\b'.format(val), sval):
-                        result[name] = symbol
-                        break
-                if name in result:
-                    break
-        return result
+            for key, option in RDEPS.items():
+                index = self._rdeps[key]
+                for token in _rdep_tokens(symbol, option):
+                    names = index.setdefault(token, [])
+                    if not names or names[-1] != name:
+                        names.append(name)
+
+    def _update_rdeps(self, old, names):
+        """
+        Replace the entries of the reverse dependency indexes of the provided
+        symbols, old maps their names to their previous data. The names are
+        kept in the order of the symbols like _index_rdeps does.
+        """
+        position = {name: i for i, name in enumerate(self.symbols)}
+        for key, option in RDEPS.items():
+            index = self._rdeps[key]
+            for name in names:
+                if name in old:
+                    for token in set(_rdep_tokens(old[name], option)):
+                        index[token].remove(name)
+                        if not index[token]:
+                            del index[token]
+            for name in names:
+                if name in self.symbols:
+                    for token in set(_rdep_tokens(self.symbols[name],
+                                                  option)):
+                        entries = index.setdefault(token, [])
+                        pos = bisect.bisect([position[n] for n in entries],
+                                            position[name])
+                        entries.insert(pos, name)
+
+    def _reparse(self):
+        """
+        Parse the whole Kconfig tree again from the (cached) file records
+        """
+        self.symbols = {}
+        self._kconfigs = {}
+        self._signatures = {}
+        self._digests = {}
+        self._unbalanced = set()
+        self._if = ()
+        self._menu = ()
+        self._choice = ()
+        self._build()
+
+    def _walk_sources(self, kconfig, parent, parent_dirty, state):
+        """
+        Follow the sourced Kconfig files like _parse_kconfig does, without
+        replaying their records, and collect the dirty files: changed or new
+        files, files that are sourced from a different file than before and
+        all the files they source
+        """
+        parents, dirty, forced, old_parents, old_signatures = state
+        if kconfig in parents:
+            return
+        parents[kconfig] = parent
+
+        source = self.source_path(kconfig)
+        records = self._get_records(source, force=source in forced)
+        is_dirty = (parent_dirty or source in forced or
+                    kconfig not in old_parents or
+                    old_parents[kconfig] != parent or
+                    old_signatures.get(source) != self._signatures[source])
+        if is_dirty:
+            dirty[kconfig] = records
+        for op, val in records:
+            if op == 'source':
+                self._walk_sources(val, kconfig, is_dirty, state)
 
     # -------------------------------------------------------------------------
     # Public methods
@@ -506,40 +1836,37 @@ class Kconfig():
         """
         Return the symbol that enables the provided kernel module
         """
-        if not self._makefiles:
-            self._makefiles = self._find_makefiles()
+        self._index_makefiles()
+        return self._objects.get(module.replace('-', '_'), '')
 
-        # Module object filename
-        fname = module.replace('_', '|').replace('-', '[_-]').replace('|', '[_-]') + '.o'
-
-        for f in self._makefiles:
-            with open(os.path.join(self.ksource, f)) as fh:
-                for line in read_line(fh):
-                    m = re.match(r'obj-\$\(CONFIG_([^\)]+)\)\s*[+:]?=.*\b{}\b'.format(fname),
-                                 line)
-                    if m:
-                        return m.group(1)
+    def directory_to_symbol(self, directory):
+        """
+        Return the symbol that gates the provided kernel source directory, or
+        its nearest conditionally built parent directory
+        """
+        self._index_makefiles()
+        path = os.path.normpath(directory)
+        while path in self._dirs:
+            if self._dirs[path]:
+                return self._dirs[path]
+            path = os.path.dirname(path)
         return ''
 
     def symbol_to_module(self, symbol):
         """
         Return the kernel module that is enabled by the provided symbol
         """
-        if not self._makefiles:
-            self._makefiles = self._find_makefiles()
+        self._index_makefiles()
+        return list(self._modules.get(symbol, []))
 
-        result = []
-        for f in self._makefiles:
-            with open(os.path.join(self.ksource, f)) as fh:
-                for line in read_line(fh):
-                    m = re.match(r'obj-\$\(CONFIG_{}\)\s*[+:]?=\s*(.*)'.format(symbol),
-                                 line)
-                    if m:
-                        for g in m.group(1).split(' '):
-                            if g.endswith('.o'):
-                                result.append(os.path.join(os.path.dirname(f),
-                                              g.replace('.o', '.ko')))
-        return result
+    def modules(self):
+        """
+        Return the kernel modules of the Makefiles indexed by the symbols
+        that enable them
+        """
+        self._index_makefiles()
+        return {symbol: list(modules) for symbol, modules in
+                self._modules.items()}
 
     def get_symbol(self, name):
         """
@@ -549,13 +1876,1127 @@ class Kconfig():
             name = name[7:]
         return self.symbols.get(name)
 
+    def sources(self):
+        """
+        Return the parsed Kconfig files, relative to the kernel source
+        """
+        return sorted(self._signatures)
+
+    def source_path(self, kconfig):
+        """
+        Return the Kconfig file path relative to the kernel source with the
+        environment variables replaced
+        """
+        srcarch = SRCARCH.get(self.arch, self.arch)
+        kconfig = kconfig.replace('$(SRCARCH)', srcarch)
+        return kconfig.replace('$SRCARCH', srcarch)
+
+    @property
+    def parents(self):
+        """
+        The parsed Kconfig files mapped to the files that sourced them, as in
+        the source statements (read-only)
+        """
+        return types.MappingProxyType(self._kconfigs)
+
+    @property
+    def digests(self):
+        """
+        The content digests of the parsed Kconfig files, relative to the
+        kernel source (read-only)
+        """
+        return types.MappingProxyType(self._digests)
+
+    def stale(self):
+        """
+        Return True if any of the parsed Kconfig files changed or vanished
+        """
+        for source, signature in self._signatures.items():
+            try:
+                if self._signature(source) != signature:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def reload(self, paths=None):
+        """
+        Reparse the changed Kconfig files and update the symbols they
+        contribute to. paths are Kconfig files, relative to the kernel source,
+        that are reparsed even if their signature didn't change. Files whose
+        (mtime, size) signature changed are always reparsed. Returns the
+        sorted names of the added, removed and changed symbols.
+        """
+        forced = set()
+        for path in paths or ():
+            if os.path.isabs(path):
+                path = os.path.relpath(path, self.ksource)
+            forced.add(os.path.normpath(path))
+
+        # Find the dirty Kconfig files, the (new) records of changed files are
+        # read on the way. Without kept records all files are read again, from
+        # the cache if possible.
+        if self._cache:
+            self._load_file_cache()
+        old_parents = self._kconfigs
+        old_signatures = self._signatures
+        parents = {}
+        dirty = {}
+        self._signatures = {}
+        try:
+            self._walk_sources(self.kconfig, None, False,
+                               (parents, dirty, forced, old_parents,
+                                old_signatures))
+        except BaseException:
+            self._signatures = old_signatures
+            raise
+
+        # Files that are no longer sourced
+        gone = [kconfig for kconfig in old_parents if kconfig not in parents]
+        if not dirty and not gone:
+            self._drop_records()
+            return {'added': [], 'removed': [], 'changed': []}
+
+        self._log.debug('Reload %s', ', '.join(list(dirty) + gone))
+        if self._help_loader:
+            self._help_loader.invalidate(
+                {self.source_path(kconfig) for kconfig in
+                 list(dirty) + gone})
+
+        # The symbols that are defined in any of the dirty or vanished files,
+        # before and after the change
+        stale = set(dirty).union(gone)
+        names = {name for name, symbol in self.symbols.items() if
+                 not stale.isdisjoint(symbol.kconfig)}
+        for records in dirty.values():
+            names.update(val for op, val in records if op == 'config')
+        old = {name: self.symbols[name] for name in names if
+               name in self.symbols}
+
+        # Replay the records of the whole tree, but only for the affected
+        # symbols, and restore the order of the symbol definitions
+        symbols = {name: symbol for name, symbol in self.symbols.items() if
+                   name not in names}
+        self.symbols = symbols
+        self._kconfigs = {}
+        self._signatures = {}
+        self._digests = {}
+        self._only = names
+        self._order = []
+        self._sink = Symbol('', (), (), ())
+        old_unbalanced = self._unbalanced
+        self._unbalanced = set()
+        self._if = ()
+        self._menu = ()
+        self._choice = ()
+        try:
+            self._parse_kconfig(self.kconfig)
+            self.symbols = {name: self.symbols[name] for name in
+                            dict.fromkeys(self._order)}
+        finally:
+            self._only = None
+            self._order = None
+            self._sink = None
+
+        # The old or the new version of a dirty file leaks blocks into the
+        # files that follow it
+        if not stale.isdisjoint(old_unbalanced | self._unbalanced):
+            self._log.debug('Unbalanced blocks, reparse the whole tree')
+            self._reparse()
+        else:
+            self._freeze_symbols(self.symbols[name] for name in names if
+                                 name in self.symbols)
+            self._update_rdeps(old, names)
+        if self._cache:
+            self._save_cache()
+        self._drop_records()
+        self._search = None
+
+        # Lazily loaded help texts are compared by the digests of their help
+        # blocks, their byte ranges move with the other lines of the file
+        def data(symbol):
+            if self._help_loader:
+                return tuple(tuple(r[3:] for r in symbol.help)
+                             if key == 'help' else getattr(symbol, key)
+                             for key in SYMBOL_KEYS)
+            return tuple(getattr(symbol, key) for key in SYMBOL_KEYS)
+
+        return {
+            'added': sorted(name for name in names if name in self.symbols and
+                            name not in old),
+            'removed': sorted(name for name in old if
+                              name not in self.symbols),
+            'changed': sorted(name for name in old if
+                              name in self.symbols and
+                              data(old[name]) != data(self.symbols[name])),
+        }
+
+    def search_help(self, query, limit=None):
+        """
+        Search the prompts, menu titles and help texts of the symbols for all
+        words of the query, a string or a list of terms. Terms ending with '*'
+        match words by prefix. Returns (name, score) tuples of the matching
+        symbols, the best matches first.
+        """
+        self._index_search()
+        if isinstance(query, str):
+            query = query.split()
+
+        postings = []
+        for term in query:
+            words = RE_SEARCH_WORD.findall(term.lower())
+            for i, word in enumerate(words):
+                prefix = term.endswith('*') and i == len(words) - 1
+                postings.append(self._search_postings(word, prefix))
+        if not postings:
+            return []
+
+        # Intersect the postings, starting with the shortest
+        postings.sort(key=len)
+        names = set(postings[0])
+        for posting in postings[1:]:
+            names.intersection_update(posting)
+        result = ((name, round(sum(p[name] for p in postings), 3)) for
+                  name in names)
+        if limit:
+            return heapq.nsmallest(limit, result, key=lambda r: (-r[1], r[0]))
+        return sorted(result, key=lambda r: (-r[1], r[0]))
+
+    def get_rdeps(self, name):
+        """
+        Return the names of the symbols that select, imply, depend on or have
+        a default referencing the provided symbol
+        """
+        if name.startswith('CONFIG_'):
+            name = name[7:]
+        return {key: list(index.get(name, [])) for key, index in
+                self._rdeps.items()}
+
     def search_symbols(self, **kwargs):
         """
-        Search and return symbols
+        Search and return the symbols that depend on, imply or select any of
+        the provided symbols
+        """
+        result = {}
+        for key, option in RDEPS.items():
+            vals = kwargs.get(option)
+            if not vals or option == 'default':
+                continue
+            index = self._rdeps[key]
+            for val in vals:
+                if val.startswith('CONFIG_'):
+                    val = val[7:]
+                for name in index.get(val, []):
+                    result[name] = self.symbols[name]
+        return result
+
+class MultiArchKconfig():
+    """
+    The Kconfig trees of multiple arches. The arch independent Kconfig files
+    are parsed only once and shared, only the files that depend on $(SRCARCH)
+    are parsed per arch. The shared records are dropped once all trees are
+    built unless keep_records is set (see Kconfig).
+    """
+    def __init__(self, ksource, kconfig, arches, log_level=logging.INFO,
+                 cache=False, rebuild_cache=False, jobs=1, lazy_help=False,
+                 profile=False, reference=None, keep_records=False):
+        self.ksource = ksource
+        self.kconfig = kconfig
+        self.arches = arches
+        self._keep_records = keep_records
+
+        # The Kconfig trees of the individual arches, they share the records
+        # of a reference tree (see Kconfig)
+        self._records = _FileRecords()
+        if reference is not None:
+            self._records.digests = next(iter(
+                reference.kconfigs.values()))._files.digests
+        self.kconfigs = {}
+        for arch in arches:
+            self.kconfigs[arch] = Kconfig(ksource, kconfig, arch,
+                                          log_level=log_level, cache=cache,
+                                          rebuild_cache=rebuild_cache,
+                                          jobs=jobs, records=self._records,
+                                          lazy_help=lazy_help,
+                                          profile=profile)
+        if not keep_records:
+            self._records.clear()
+
+    # -------------------------------------------------------------------------
+    # Public methods
+
+    def get_symbol(self, name):
+        """
+        Return the symbol data of all arches that define the symbol, indexed
+        by arch
         """
         result = {}
-        for key in ('depends_on', 'imply', 'select'):
-            vals = kwargs.get(key)
-            if vals:
-                result |= self._search_symbols(key, vals)
+        for arch, kconfig in self.kconfigs.items():
+            symbol = kconfig.get_symbol(name)
+            if symbol:
+                result[arch] = symbol
         return result
+
+    def sources(self):
+        """
+        Return the parsed Kconfig files of all arches, relative to the kernel
+        source
+        """
+        return sorted(set().union(*(kconfig.sources() for kconfig in
+                                    self.kconfigs.values())))
+
+    @property
+    def digests(self):
+        """
+        The content digests of the parsed Kconfig files of all arches,
+        relative to the kernel source (read-only)
+        """
+        digests = {}
+        for kconfig in self.kconfigs.values():
+            digests.update(kconfig.digests)
+        return types.MappingProxyType(digests)
+
+    def stale(self):
+        """
+        Return True if any of the parsed Kconfig files changed or vanished
+        """
+        return any(kconfig.stale() for kconfig in self.kconfigs.values())
+
+    def reload(self, paths=None):
+        """
+        Reparse the changed Kconfig files of all arches and return the added,
+        removed and changed symbols indexed by arch
+        """
+        result = {arch: kconfig.reload(paths) for arch, kconfig in
+                  self.kconfigs.items()}
+        if not self._keep_records:
+            self._records.clear()
+        return result
+
+    def symbol_arches(self, name):
+        """
+        Return the arches that define the provided symbol
+        """
+        return list(self.get_symbol(name))
+
+    def search_symbols(self, **kwargs):
+        """
+        Search symbols in all arches and return the results indexed by arch.
+        Arches without results are omitted.
+        """
+        result = {}
+        for arch, kconfig in self.kconfigs.items():
+            symbols = kconfig.search_symbols(**kwargs)
+            if symbols:
+                result[arch] = symbols
+        return result
+
+# -----------------------------------------------------------------------------
+# Kconfig expressions
+
+# Tristate values
+TRISTATE = {'n': 0, 'm': 1, 'y': 2}
+TRISTATE_NAMES = ('n', 'm', 'y')
+
+RE_EXPR_LEXER = re.compile(r'\s*(?:(\|\||&&|!=|<=|>=|[!=<>()])|' +
+                           r'("(?:[^"\\]|\\.)*"|\'[^\']*\')|' +
+                           r'([^\s!=<>()&|"\']+))')
+RE_EXPR_CONDITION = re.compile(r'^((?:"[^"]*"|[^"])*?)\s+if\s+(.*)$')
+
+# The compiled form of 'y' and 'n'
+EXPR_Y = ('const', 'y')
+EXPR_N = ('const', 'n')
+
+_compiled_exprs = {}
+
+def _expr_tokens(expr):
+    """
+    Split a Kconfig expression into operator and operand tokens
+    """
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        # Trailing comment
+        start = len(expr) - len(expr[pos:].lstrip())
+        if expr.startswith('#', start):
+            break
+
+        # Macros like $(cc-option,...) can contain nested parentheses
+        if expr.startswith('$(', start):
+            depth = 0
+            for pos in range(start, len(expr)):
+                if expr[pos] == '(':
+                    depth += 1
+                elif expr[pos] == ')':
+                    depth -= 1
+                    if not depth:
+                        break
+            pos += 1
+            tokens.append(('macro', expr[start:pos]))
+            continue
+
+        m = RE_EXPR_LEXER.match(expr, pos)
+        if not m:
+            raise ValueError('Invalid expression: {}'.format(expr))
+        op, string, word = m.groups()
+        if op:
+            tokens.append(op)
+        elif string:
+            tokens.append(('const', string[1:-1]))
+        elif word in TRISTATE or word[0].isdigit() or word[0] == '-':
+            tokens.append(('const', word))
+        else:
+            tokens.append(('sym', word))
+        pos = m.end()
+    return tokens
+
+def _parse_or(tokens, pos):
+    left, pos = _parse_and(tokens, pos)
+    while pos < len(tokens) and tokens[pos] == '||':
+        right, pos = _parse_and(tokens, pos + 1)
+        left = ('or', left, right)
+    return left, pos
+
+def _parse_and(tokens, pos):
+    left, pos = _parse_not(tokens, pos)
+    while pos < len(tokens) and tokens[pos] == '&&':
+        right, pos = _parse_not(tokens, pos + 1)
+        left = ('and', left, right)
+    return left, pos
+
+def _parse_not(tokens, pos):
+    if pos < len(tokens) and tokens[pos] == '!':
+        operand, pos = _parse_not(tokens, pos + 1)
+        return ('not', operand), pos
+    return _parse_compare(tokens, pos)
+
+def _parse_compare(tokens, pos):
+    left, pos = _parse_operand(tokens, pos)
+    if pos < len(tokens) and tokens[pos] in ('=', '!=', '<', '<=', '>', '>='):
+        op = tokens[pos]
+        right, pos = _parse_operand(tokens, pos + 1)
+        return ('cmp', op, left, right), pos
+    return left, pos
+
+def _parse_operand(tokens, pos):
+    if pos >= len(tokens):
+        raise ValueError('Unexpected end of expression')
+    token = tokens[pos]
+    if token == '(':
+        operand, pos = _parse_or(tokens, pos + 1)
+        if pos >= len(tokens) or tokens[pos] != ')':
+            raise ValueError('Missing closing parenthesis')
+        return operand, pos + 1
+    if isinstance(token, str):
+        raise ValueError('Unexpected operator: {}'.format(token))
+    return token, pos + 1
+
+def compile_expr(expr):
+    """
+    Compile a Kconfig expression into nested tuples:
+      ('const', value), ('sym', name), ('macro', text), ('not', e),
+      ('and', e1, e2), ('or', e1, e2) and ('cmp', op, e1, e2)
+    Compiled expressions are cached so that every distinct expression is
+    parsed only once and equal expressions share the compiled form.
+    """
+    compiled = _compiled_exprs.get(expr)
+    if compiled is None:
+        tokens = _expr_tokens(expr)
+        compiled, pos = _parse_or(tokens, 0)
+        if pos != len(tokens):
+            raise ValueError('Trailing tokens in expression: {}'.format(expr))
+        _compiled_exprs[expr] = compiled
+    return compiled
+
+def split_condition(val):
+    """
+    Split an option value like '"Prompt" if FOO' or 'y if BAR' into the value
+    and the condition. The condition is None if there is none.
+    """
+    m = RE_EXPR_CONDITION.match(val)
+    if m:
+        return m.group(1), m.group(2)
+    return val, None
+
+def _and_exprs(exprs):
+    """
+    Combine compiled expressions with '&&'
+    """
+    result = EXPR_Y
+    for expr in exprs:
+        result = expr if result is EXPR_Y else ('and', result, expr)
+    return result
+
+def read_config(config):
+    """
+    Read a .config file and return a dict of the symbol values. Symbols that
+    are 'not set' have the value 'n', string values are unquoted.
+    """
+    values = {}
+    with open(config) as fh:
+        for line in fh:
+            line = line.strip()
+            if line.startswith('# CONFIG_') and line.endswith(' is not set'):
+                values[line[9:-11]] = 'n'
+            elif line.startswith('CONFIG_') and '=' in line:
+                name, val = line[7:].split('=', 1)
+                if len(val) > 1 and val[0] == '"' and val[-1] == '"':
+                    val = val[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+                values[name] = val
+    return values
+
+def _number(val):
+    """
+    Return the numeric value of a string or None
+    """
+    try:
+        return int(val, 0)
+    except ValueError:
+        return None
+
+class ConfigEvaluator():
+    """
+    Evaluate the symbol dependencies, visibility and defaults of a Kconfig
+    tree against .config files.
+
+    The symbol expressions (including the inherited 'if', 'menu' and 'choice'
+    conditions) are compiled once per tree and reused for every config. The
+    expression values are memoized per config.
+    """
+    def __init__(self, kconfig):
+        self.kconfig = kconfig
+
+        # Compiled dependency, visibility and default expressions by symbol
+        self._compiled = {}
+
+        # The values of the current config and the memoized expression
+        # values, indexed by the id() of the compiled expression
+        self._values = {}
+        self._memo = {}
+
+    def _compile(self, expr):
+        try:
+            return compile_expr(expr)
+        except ValueError as e:
+            self.kconfig._log.debug('%s', e)  # pylint: disable=W0212
+            return EXPR_N
+
+    def _compile_symbol(self, name):
+        """
+        Compile the expressions of a symbol
+        """
+        symbol = self.kconfig.symbols[name]
+
+        # The dependencies of the symbol and of its enclosing 'if', 'menu' and
+        # 'choice' blocks
+        deps = [self._compile(e) for e in symbol['depends_on']]
+        deps += [self._compile(e) for e in symbol['if']]
+        for data in symbol['menu'] + symbol['choice']:
+            deps += [self._compile(e) for e in data['depends_on']]
+        dep = _and_exprs(deps)
+
+        # The prompts with their conditions and the menu 'visible if'
+        # conditions
+        prompts = []
+        for entry in symbol['type']:
+            for val in entry.values():
+                if val and val.startswith('"'):
+                    cond = split_condition(val)[1]
+                    prompts.append(self._compile(cond) if cond else EXPR_Y)
+        prompts += [EXPR_Y for _ in symbol['prompt']]
+        visible_if = _and_exprs([self._compile(e) for data in symbol['menu']
+                                 for e in data['visible_if']])
+
+        # The defaults with their conditions
+        defaults = []
+        for entry in symbol['default']:
+            for kind, val in entry.items():
+                val, cond = split_condition(val)
+                defaults.append((kind, val, self._compile(cond) if cond
+                                 else EXPR_Y))
+
+        compiled = (dep, prompts, visible_if, defaults)
+        self._compiled[name] = compiled
+        return compiled
+
+    def _tristate(self, node):
+        """
+        Return the tristate value (0, 1, 2) of a compiled expression
+        """
+        key = id(node)
+        val = self._memo.get(key)
+        if val is not None:
+            return val
+
+        op = node[0]
+        if op == 'sym':
+            val = TRISTATE.get(self._values.get(node[1], 'n'), 0)
+        elif op == 'const':
+            val = TRISTATE.get(node[1], 0)
+            if val == 1 and self._values.get('MODULES') != 'y':
+                # 'm' is 'n' if modules are disabled
+                val = 0
+        elif op == 'macro':
+            # Macros depend on the toolchain, assume they evaluate to 'y'
+            val = 2
+        elif op == 'not':
+            val = 2 - self._tristate(node[1])
+        elif op == 'and':
+            val = min(self._tristate(node[1]), self._tristate(node[2]))
+        elif op == 'or':
+            val = max(self._tristate(node[1]), self._tristate(node[2]))
+        else:
+            val = 2 if self._compare(node[1], node[2], node[3]) else 0
+
+        self._memo[key] = val
+        return val
+
+    def _string(self, node):
+        """
+        Return the string value of a compiled operand
+        """
+        if node[0] == 'sym':
+            return self._values.get(node[1], 'n')
+        if node[0] in ('const', 'macro'):
+            return node[1]
+        return TRISTATE_NAMES[self._tristate(node)]
+
+    def _compare(self, op, left, right):
+        left = self._string(left)
+        right = self._string(right)
+        left_num = _number(left)
+        right_num = _number(right)
+        if left_num is not None and right_num is not None:
+            left, right = left_num, right_num
+        if op == '=':
+            return left == right
+        if op == '!=':
+            return left != right
+        if type(left) is not type(right):
+            left, right = str(left), str(right)
+        if op == '<':
+            return left < right
+        if op == '<=':
+            return left <= right
+        if op == '>':
+            return left > right
+        return left >= right
+
+    # -------------------------------------------------------------------------
+    # Public methods
+
+    def set_config(self, config):
+        """
+        Set the config to evaluate against, either the path of a .config file
+        or a dict of symbol values
+        """
+        self._values = read_config(config) if isinstance(config, str) \
+            else config
+        self._memo = {}
+
+    def eval_expr(self, expr):
+        """
+        Return the value ('n', 'm' or 'y') of a Kconfig expression
+        """
+        return TRISTATE_NAMES[self._tristate(self._compile(expr))]
+
+    def evaluate(self, name):
+        """
+        Return the value, the dependency value, the visibility and the
+        applying defaults of a symbol for the current config
+        """
+        compiled = self._compiled.get(name)
+        if compiled is None:
+            compiled = self._compile_symbol(name)
+        dep, prompts, visible_if, defaults = compiled
+
+        dep_val = self._tristate(dep)
+        visible = max([self._tristate(p) for p in prompts], default=0)
+        visible = min(visible, dep_val, self._tristate(visible_if))
+
+        applying = []
+        for kind, val, cond in defaults:
+            if self._tristate(cond):
+                applying.append({kind: val})
+
+        return {
+            'value': self._values.get(name, 'n'),
+            'dep': TRISTATE_NAMES[dep_val],
+            'visible': TRISTATE_NAMES[visible],
+            'defaults': applying,
+        }
+
+    def evaluate_configs(self, configs, names=None):
+        """
+        Evaluate the provided symbols (all symbols by default) against a batch
+        of configs. Yields a (config, results) tuple per config.
+        """
+        if names is None:
+            names = sorted(self.kconfig.symbols)
+        for config in configs:
+            self.set_config(config)
+            yield config, {name: self.evaluate(name) for name in names}
+
+# -----------------------------------------------------------------------------
+# Kconfig tree comparison
+
+def _dirty_kconfigs(old, new):
+    """
+    Return the Kconfig files whose symbols can differ between two trees: the
+    files whose content or sourcing file differs or that exist in only one of
+    the trees, and all the files they source
+    """
+    dirty = set()
+    for kconfig in set(old.parents).union(new.parents):
+        if kconfig not in old.parents or kconfig not in new.parents or \
+           old.parents[kconfig] != new.parents[kconfig]:
+            dirty.add(kconfig)
+            continue
+        digest = old.digests.get(old.source_path(kconfig))
+        if digest is None or \
+           digest != new.digests.get(new.source_path(kconfig)):
+            dirty.add(kconfig)
+
+    # Add the files sourced by dirty files
+    children = {}
+    for tree in (old, new):
+        for kconfig, parent in tree.parents.items():
+            children.setdefault(parent, set()).add(kconfig)
+    queue = list(dirty)
+    while queue:
+        for child in children.get(queue.pop(), ()):
+            if child not in dirty:
+                dirty.add(child)
+                queue.append(child)
+    return dirty
+
+def diff_kconfigs(old, new):
+    """
+    Compare the symbols of two Kconfig trees of the same arch, like two kernel
+    versions. Only the symbols defined in Kconfig files that differ between
+    the trees are compared. Returns the sorted names of the added and removed
+    symbols and the old and new values of the changed options of the changed
+    symbols.
+    """
+    dirty = _dirty_kconfigs(old, new)
+    names = set()
+    for tree in (old, new):
+        names.update(name for name, symbol in tree.symbols.items() if
+                     not dirty.isdisjoint(symbol.kconfig))
+
+    changed = {}
+    for name in sorted(names):
+        if name not in old.symbols or name not in new.symbols:
+            continue
+        options = {}
+        for key in SYMBOL_KEYS[1:]:
+            old_val = old.symbols[name][key]
+            new_val = new.symbols[name][key]
+            if old_val != new_val:
+                options[key] = {'old': old_val, 'new': new_val}
+        if options:
+            changed[name] = options
+
+    return {
+        'added': sorted(names.difference(old.symbols)),
+        'removed': sorted(names.difference(new.symbols)),
+        'changed': changed,
+    }
+
+# -----------------------------------------------------------------------------
+# Module resolution, like 'make localmodconfig'
+
+def read_modules(fh):
+    """
+    Return the module names of lsmod output, /proc/modules or a plain list of
+    module names, one per line
+    """
+    modules = []
+    for line in fh:
+        words = line.split(None, 1)
+        if not words or words[0].startswith('#'):
+            continue
+        if words[0] == 'Module' and not modules:
+            # lsmod header
+            continue
+        modules.append(words[0])
+    return modules
+
+def _required_symbols(node):
+    """
+    Return the symbols of a compiled expression that need to be enabled for
+    the expression to be true. Negated symbols aren't required and of the
+    alternatives of '||' only the one that requires fewer symbols is, the
+    left one if they require the same number.
+    """
+    kind = node[0]
+    if kind == 'sym':
+        return [node[1]]
+    if kind == 'and':
+        return _required_symbols(node[1]) + _required_symbols(node[2])
+    if kind == 'or':
+        left = _required_symbols(node[1])
+        right = _required_symbols(node[2])
+        return right if len(right) < len(left) else left
+    if kind == 'cmp':
+        op, left, right = node[1:]
+        if left[0] == 'const':
+            left, right = right, left
+        if left[0] == 'sym' and right[0] == 'const' and \
+           ((op == '=' and right[1] in ('y', 'm')) or
+            (op == '!=' and right[1] == 'n')):
+            return [left[1]]
+    return []
+
+class ModuleResolver():
+    """
+    Resolve kernel modules to the symbols that enable them and to the minimal
+    set of symbols that needs to be enabled for them: the symbols that their
+    dependencies (including the inherited 'if', 'menu' and 'choice'
+    conditions) require and the symbols they select, recursively.
+
+    The modules are resolved with the Makefile index of the tree and the
+    transitive closures of the symbols are memoized, so resolving many module
+    lists against the same tree only walks every symbol once.
+    """
+    def __init__(self, kconfig):
+        self.kconfig = kconfig
+
+        # The direct requirements and the transitive closure by symbol
+        self._edges = {}
+        self._closures = {}
+
+    def _requires(self, name):
+        """
+        Return the symbols that the provided symbol directly requires
+        """
+        edges = self._edges.get(name)
+        if edges is not None:
+            return edges
+
+        symbol = self.kconfig.symbols[name]
+        exprs = list(symbol['depends_on']) + list(symbol['if'])
+        for data in symbol['menu'] + symbol['choice']:
+            exprs += data['depends_on']
+        names = []
+        for expr in exprs:
+            try:
+                names += _required_symbols(compile_expr(expr))
+            except ValueError as e:
+                self.kconfig._log.debug('%s', e)  # pylint: disable=W0212
+        names += [val.split(None, 1)[0] for val in symbol['select']]
+
+        edges = tuple(n for n in dict.fromkeys(names) if
+                      n != name and n in self.kconfig.symbols)
+        self._edges[name] = edges
+        return edges
+
+    def _close(self, root):
+        """
+        Compute the closures of root and of all symbols it requires with
+        Tarjan's strongly connected components algorithm, so that symbols that
+        require each other share their closure
+        """
+        index = {root: 0}
+        low = {root: 0}
+        stack = [root]
+        on_stack = {root}
+        work = [(root, iter(self._requires(root)))]
+        while work:
+            node, edges = work[-1]
+            for succ in edges:
+                if succ in self._closures:
+                    continue
+                if succ not in index:
+                    index[succ] = low[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(self._requires(succ))))
+                    break
+                if succ in on_stack:
+                    low[node] = min(low[node], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] != index[node]:
+                    continue
+
+                # node is the root of a strongly connected component
+                component = []
+                while True:
+                    name = stack.pop()
+                    on_stack.discard(name)
+                    component.append(name)
+                    if name == node:
+                        break
+                closure = set(component)
+                for name in component:
+                    for succ in self._requires(name):
+                        if succ not in closure:
+                            closure |= self._closures[succ]
+                closure = frozenset(closure)
+                for name in component:
+                    self._closures[name] = closure
+
+    def closure(self, name):
+        """
+        Return the symbols that need to be enabled for the provided symbol,
+        including the symbol itself
+        """
+        if name not in self._closures:
+            self._close(name)
+        return self._closures[name]
+
+    def resolve(self, modules):
+        """
+        Resolve the provided modules and return the symbols that enable them
+        indexed by module, the sorted names of the symbols that need to be
+        enabled and the modules that can't be resolved to a symbol of this
+        tree
+        """
+        resolved = {}
+        unresolved = []
+        for module in modules:
+            name = self.kconfig.module_to_symbol(module)
+            if name in self.kconfig.symbols:
+                resolved[module] = name
+            else:
+                unresolved.append(module)
+
+        symbols = set()
+        for name in set(resolved.values()):
+            symbols |= self.closure(name)
+
+        return {
+            'modules': resolved,
+            'symbols': sorted(symbols),
+            'unresolved': unresolved,
+        }
+
+# -----------------------------------------------------------------------------
+# Symbol data export
+
+SQLITE_SCHEMA = '''
+CREATE TABLE symbols (name TEXT PRIMARY KEY, type TEXT, prompt TEXT,
+                      help TEXT, data TEXT);
+CREATE TABLE source_files (symbol TEXT, path TEXT);
+CREATE TABLE dependencies (symbol TEXT, expr TEXT, origin TEXT);
+CREATE TABLE selects (symbol TEXT, target TEXT, condition TEXT, kind TEXT);
+CREATE TABLE defaults (symbol TEXT, kind TEXT, value TEXT, condition TEXT);
+CREATE TABLE makefile_objects (object TEXT, symbol TEXT, module TEXT);
+CREATE INDEX source_files_symbol ON source_files (symbol);
+CREATE INDEX source_files_path ON source_files (path);
+CREATE INDEX dependencies_symbol ON dependencies (symbol);
+CREATE INDEX selects_symbol ON selects (symbol);
+CREATE INDEX selects_target ON selects (target);
+CREATE INDEX defaults_symbol ON defaults (symbol);
+CREATE INDEX makefile_objects_object ON makefile_objects (object);
+CREATE INDEX makefile_objects_symbol ON makefile_objects (symbol);
+'''
+
+def dump_json(kconfig, fh):
+    """
+    Write the symbol data of a Kconfig tree as a single JSON object
+    """
+    json.dump(kconfig.symbols, fh, sort_keys=True, indent=4, default=dict)
+    fh.write('\n')
+
+def dump_ndjson(kconfig, fh):
+    """
+    Write the symbol data of a Kconfig tree as one JSON object per line,
+    sorted by symbol name
+    """
+    for name in sorted(kconfig.symbols):
+        fh.write(json.dumps(kconfig.symbols[name], sort_keys=True,
+                            default=dict))
+        fh.write('\n')
+
+def _sqlite_rows(kconfig):
+    """
+    Yield the (table, row) tuples of the SQLite export
+    """
+    for name in sorted(kconfig.symbols):
+        symbol = kconfig.symbols[name]
+        stype = prompt = None
+        if symbol['type']:
+            stype, prompt = next(iter(symbol['type'][0].items()))
+            prompt = prompt or None
+        if symbol['prompt']:
+            prompt = symbol['prompt'][0]
+        yield 'symbols', (name, stype, prompt, '\n'.join(symbol['help']),
+                          json.dumps(symbol, sort_keys=True, default=dict))
+
+        for path in symbol['kconfig']:
+            yield 'source_files', (name, kconfig.source_path(path))
+        for origin in ('depends_on', 'if'):
+            for expr in symbol[origin]:
+                yield 'dependencies', (name, expr, origin)
+        for kind in ('select', 'imply'):
+            for val in symbol[kind]:
+                target, condition = split_condition(val)
+                yield 'selects', (name, target, condition, kind)
+        for entry in symbol['default']:
+            for kind, val in entry.items():
+                value, condition = split_condition(val)
+                yield 'defaults', (name, kind, value, condition)
+
+    for symbol, modules in sorted(kconfig.modules().items()):
+        for module in modules:
+            obj = os.path.basename(module[:-3]).replace('-', '_')
+            yield 'makefile_objects', (obj, symbol, module)
+
+def dump_sqlite(kconfig, path):
+    """
+    Write the symbol data of a Kconfig tree to a new SQLite database with
+    tables for symbols, dependencies, selects/implies, defaults, source files
+    and Makefile objects
+    """
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        os.unlink(tmp)
+
+    db = sqlite3.connect(tmp)
+    try:
+        db.executescript(SQLITE_SCHEMA)
+        rows = {}
+        for table, row in _sqlite_rows(kconfig):
+            rows.setdefault(table, []).append(row)
+        for table, table_rows in rows.items():
+            db.executemany('INSERT INTO {} VALUES ({})'.format(
+                table, ', '.join('?' * len(table_rows[0]))), table_rows)
+        db.commit()
+    finally:
+        db.close()
+    os.replace(tmp, path)
+
+# -----------------------------------------------------------------------------
+# Kconfig file formatting, shared by kconfig-check and kconfig-fix
+
+RE_FORMAT_COMMENT = re.compile(r'^\t*#(\s|$)')
+RE_FORMAT_BLOCK = re.compile(r'^(endif|if|endmenu|menu(?!config)|endchoice|' +
+                             r'choice)')
+RE_FORMAT_IF = re.compile(r'^if (.+)$')
+RE_FORMAT_MENU = re.compile(r'^menu (.+)$')
+RE_FORMAT_END = re.compile(r'^(?:endif|endmenu) # (.+)$')
+RE_FORMAT_KEYWORD = re.compile(r'^(' +
+                               r'(config|menuconfig|depends on) |' +
+                               r'(source|comment|mainmenu) "' +
+                               r')')
+RE_FORMAT_OPTION = re.compile(r'^\t(' +
+                              r'(default|def_bool|depends on|imply|range|' +
+                              r'select) [^\']|' +
+                              r'prompt "|' +
+                              r'optional$|' +
+                              r'def_tristate (y|n|m)|' +
+                              r'(bool|hex|int|string|tristate)($| ")' +
+                              r')')
+RE_FORMAT_CHOICE_OPTION = re.compile(r'^\t\t(' +
+                                     r'(depends on|select) [^\']|' +
+                                     r'bool($| ")' +
+                                     r')')
+RE_FORMAT_QUOTES = re.compile(r'^\t(hex|bool|default) \'')
+
+def classify_line(line):
+    """
+    Classify a line of a Kconfig file (without trailing whitespaces) by its
+    formatting and return a (kind, arg) tuple. kind is one of:
+
+      comment:       Empty line or comment
+      if, menu:      1st level block start, arg is the condition or menu
+                     text or None if the line is malformed
+      endif,
+      endmenu:       1st level block end, arg is the '# <comment>' text or
+                     None if it's missing or malformed
+      choice,
+      endchoice:     1st level choice block, arg is '' or None if the line
+                     is malformed
+      keyword:       Other 1st level keywords
+      help, config,
+      option:        2nd level 'help', 'config' and other keywords
+      choice_help,
+      choice_option: 3rd level 'help' and other keywords of choice configs
+      quotes:        2nd level keyword with single quotes
+      None:          Anything else, like help text
+    """
+    if line == '' or RE_FORMAT_COMMENT.match(line):
+        return 'comment', None
+
+    m = RE_FORMAT_BLOCK.match(line)
+    if m:
+        kind = m.group(1)
+        if kind in ('choice', 'endchoice'):
+            return kind, '' if line == kind else None
+        if kind == 'if':
+            m = RE_FORMAT_IF.match(line)
+        elif kind == 'menu':
+            m = RE_FORMAT_MENU.match(line)
+        else:
+            m = RE_FORMAT_END.match(line)
+        return kind, m.group(1) if m else None
+
+    if RE_FORMAT_KEYWORD.match(line):
+        return 'keyword', None
+    if line == '\thelp':
+        return 'help', None
+    if line.startswith('\tconfig '):
+        return 'config', None
+    if RE_FORMAT_OPTION.match(line):
+        return 'option', None
+    if line == '\t\thelp':
+        return 'choice_help', None
+    if RE_FORMAT_CHOICE_OPTION.match(line):
+        return 'choice_option', None
+    if RE_FORMAT_QUOTES.match(line):
+        return 'quotes', None
+    return None, None
+
+def find_kconfigs(ksource):
+    """
+    Find all Kconfig files of a kernel source tree, skipping hidden
+    directories
+    """
+    result = []
+    for path, dirs, files in os.walk(ksource):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for f in files:
+            if f.startswith('Kconfig'):
+                result.append(os.path.join(path, f))
+    return sorted(result)
+
+# Map the Kconfig keywords to their handlers
+KEYWORDS = {
+    'source': _Reader._kw_source,
+    'if': _Reader._kw_if,
+    'endif': _Reader._kw_endif,
+    'comment': _Reader._kw_comment,
+    'depends': _Reader._kw_depends,
+    'menu': _Reader._kw_menu,
+    'mainmenu': _Reader._kw_menu,
+    'endmenu': _Reader._kw_endmenu,
+    'visible': _Reader._kw_visible,
+    'choice': _Reader._kw_choice,
+    'endchoice': _Reader._kw_endchoice,
+    'config': _Reader._kw_config,
+    'menuconfig': _Reader._kw_config,
+    'help': _Reader._kw_help,
+    '---help': _Reader._kw_help,
+    'help---': _Reader._kw_help,
+    '---help---': _Reader._kw_help,
+    'prompt': _Reader._kw_prompt,
+    'bool': _Reader._kw_type,
+    'string': _Reader._kw_type,
+    'int': _Reader._kw_type,
+    'tristate': _Reader._kw_type,
+    'hex': _Reader._kw_type,
+    'default': _Reader._kw_default,
+    'def_bool': _Reader._kw_default,
+    'def_tristate': _Reader._kw_default,
+    'select': _Reader._kw_option,
+    'range': _Reader._kw_option,
+    'option': _Reader._kw_option,
+    'imply': _Reader._kw_option,
+    'modules': _Reader._kw_modules,
+}